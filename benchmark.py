@@ -0,0 +1,328 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark suite for the simulation hot paths.
+
+Every benchmark case is timed as the best of `repeat` repeats and its peak
+Python/NumPy allocation is measured with tracemalloc in one extra call made
+outside the timing. Results are written as JSON together with the versions and
+machine they were measured on, and can be compared against an earlier results
+file to flag regressions:
+
+    python benchmark.py --output bench.json
+    python benchmark.py --compare bench.json --threshold 0.2
+
+Import times of the core modules are measured in fresh interpreters and
+reported as import.<module> cases, listing any of pandas, scipy, matplotlib
+or numba that the import pulled in.
+
+The end-to-end runs cover 1, 365 and 10,000 days of 1, 1,000 and 10,000
+tanks, recording into a results.FleetAggregator so memory stays bounded.
+The largest combinations take a long time, so --quick, --days and --tanks
+limit the grid.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+import numpy as np
+
+END_TO_END_DAYS = (1, 365, 10000)
+END_TO_END_TANKS = (1, 1000, 10000)
+QUICK_DAYS = (1,)
+QUICK_TANKS = (1, 1000)
+IMPORT_MODULES = ('ewh_sim', 'fleet', 'kernel', 'stratified', 'weather', 'results', 'user',
+                  'shower', 'controllers', 'population')
+HEAVY_MODULES = ('pandas', 'scipy', 'matplotlib', 'numba')
+
+# name -> setup function returning (callable, units of work per call, unit name)
+cases = {}
+
+def case(name):
+    def register(setup):
+        cases[name] = setup
+        return setup
+    return register
+
+@case('shower.simulate')
+def shower_simulate(rng):
+    import shower
+    import user
+
+    sim_shower = shower.Shower()
+    sim_user = user.User(age='work_ad', rng=rng)
+    return (lambda: sim_shower.simulate(sim_user, rng=rng)), 1, 'showers'
+
+@case('shower.simulate_batch')
+def shower_simulate_batch(rng):
+    import shower
+    import user
+
+    sim_shower = shower.Shower()
+    users = [user.User(age='work_ad', rng=rng) for _ in range(1000)]
+    return (lambda: sim_shower.simulate_batch(users, rng=rng)), 1000, 'showers'
+
+@case('user.User')
+def user_construction(rng):
+    import user
+
+    return (lambda: user.User(age='work_ad', rng=rng)), 1, 'users'
+
+@case('user.UserSchedule')
+def schedule_construction(rng):
+    import user
+
+    sim_user = user.User(age='work_ad', rng=rng)
+    return (lambda: user.UserSchedule(weekday=True, user=sim_user, rng=rng)), 1, 'schedules'
+
+@case('user.generate_pdf')
+def generate_pdf(rng):
+    import user
+
+    sim_user = user.User(age='work_ad', rng=rng)
+    return sim_user.generate_pdf, 1, 'schedules'
+
+@case('ewh.period_loop')
+def ewh_period_loop(rng):
+    """One day of the scalar EWH update (standing loss, draw, element) at 60 s steps."""
+    import ewh_sim
+
+    ewh = ewh_sim.EWH(always_on=True)
+    ewh.is_active = True
+    ewh.randomise_settings(rng)
+    ambient = rng.uniform(0, 30, 1440).tolist()
+    draws = (rng.random(1440) < 0.01).tolist()
+
+    def loop():
+        for period in range(1440):
+            ewh.current_temp = ewh.standing_loss(ambient[period], 60)
+            if draws[period]:
+                ewh.current_temp = ewh.draw_event_loss(time_step=60)
+            ewh.update_element(60)
+    return loop, 1440, 'tank-steps'
+
+@case('fleet.step')
+def fleet_step(rng):
+    """One day of EWHFleet.step for 1,000 tanks at 60 s steps."""
+    import fleet
+
+    tanks = fleet.EWHFleet(1000, always_on=True)
+    tanks.randomise_settings(rng)
+    decay = tanks.calculate_decay(60)
+    ambient = rng.uniform(0, 30, 1440)
+    draw_rate = np.where(rng.random((1440, 1000)) < 0.01, 0.142, 0.0)
+
+    def loop():
+        for period in range(1440):
+            tanks.step(ambient[period], draw_rate[period], 60, decay=decay)
+    return loop, 1440*1000, 'tank-steps'
+
+@case('weather.lookup')
+def weather_lookup(rng):
+    """1,440 scalar hourly lookups, as made by a per-period loop."""
+    from weather import WeatherSource
+
+    weather = WeatherSource.from_csv()
+    hours = rng.integers(0, 10000*24, 1440).tolist()
+
+    def lookup():
+        for hour in hours:
+            weather[hour]
+    return lookup, 1440, 'lookups'
+
+@case('weather.profile')
+def weather_profile(rng):
+    """A day of ambient temperatures at 60 s steps."""
+    from weather import WeatherSource
+
+    weather = WeatherSource.from_csv()
+    return (lambda: weather.profile(int(rng.integers(0, 10000*1440)), 1440, 60)), 1440, 'steps'
+
+@case('population.generate')
+def population_generate(rng):
+    """One day of merged shower draws for 100,000 households."""
+    import population
+
+    seed = int(rng.integers(2**31))
+    return (lambda: population.generate(100000, days=1, seed=seed)), 100000, 'households'
+
+def end_to_end(days, tanks, engine):
+    def setup(rng):
+        import ewh_sim
+        import fleet
+        import user
+        from results import FleetAggregator
+        from weather import WeatherSource
+
+        weather = WeatherSource.from_csv()
+        users = [user.User(age='work_ad', rng=rng) for _ in range(min(tanks, 100))]
+        users = [users[i % len(users)] for i in range(tanks)]
+
+        def run():
+            heaters = fleet.EWHFleet(tanks, always_on=True)
+            heaters.randomise_settings(rng)
+            sim = ewh_sim.Simulation(time_step=60)
+            results = FleetAggregator(1440*days, interval=60, days=days)
+            sim.run(heaters, users, weather=weather, days=days, results=results, rng=rng,
+                    engine=engine)
+        return run, days*tanks, 'tank-days'
+    return setup
+
+def timed(function, number):
+    start = time.perf_counter()
+    for _ in range(number):
+        function()
+    return (time.perf_counter() - start)/number
+
+def measure(setup, repeat=3, min_time=0.2, memory=True, memory_limit=30.0, seed=0):
+    """Time a benchmark case and return its statistics as a dict.
+
+    Fast cases are called `number` times per repeat so every repeat takes at
+    least min_time seconds; best and mean are seconds per call.
+    """
+    rng = np.random.default_rng(seed)
+    function, units, unit = setup(rng)
+    # the first call also absorbs caching and JIT compilation
+    first = timed(function, 1)
+    number = 1 if first >= min_time else int(min_time/max(first, 1e-9)) + 1
+    timings = [timed(function, number) for _ in range(repeat)]
+    best = min(timings)
+    result = {'best': best, 'mean': sum(timings)/len(timings), 'repeat': repeat,
+              'number': number, 'units': units, 'unit': unit, 'throughput': units/best if best else None,
+              'peak_memory': None}
+    # allocation tracing slows Python code down, so it gets a call of its own
+    if memory and best <= memory_limit:
+        tracemalloc.start()
+        try:
+            function()
+            result['peak_memory'] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return result
+
+IMPORT_SCRIPT = """
+import sys, time
+start = time.perf_counter()
+import {0}
+print(time.perf_counter() - start)
+print(','.join(name for name in {1!r} if name in sys.modules))
+"""
+
+def measure_import(module, repeat=3):
+    """Time importing module (including NumPy) in `repeat` fresh interpreters."""
+    directory = os.path.dirname(os.path.abspath(__file__))
+    timings = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, '-c', IMPORT_SCRIPT.format(module, HEAVY_MODULES)],
+                                capture_output=True, text=True, cwd=directory, check=True).stdout.split('\n')
+        timings.append(float(output[0]))
+    best = min(timings)
+    return {'best': best, 'mean': sum(timings)/len(timings), 'repeat': repeat, 'number': 1,
+            'units': 1, 'unit': 'imports', 'throughput': 1/best, 'peak_memory': None,
+            'loaded': [name for name in output[1].split(',') if name]}
+
+def environment():
+    """Return the versions and machine details stored with the results."""
+    import kernel
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                                text=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+                                check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'commit': commit, 'python': platform.python_version(), 'numpy': np.__version__,
+            'numba': kernel.available(), 'machine': platform.machine(),
+            'processor': platform.processor(), 'cpus': os.cpu_count(),
+            'timestamp': datetime.datetime.now().isoformat(timespec='seconds')}
+
+def run_benchmarks(names=None, days=END_TO_END_DAYS, tanks=END_TO_END_TANKS, engine=None,
+                   repeat=3, memory=True, seed=0, log=print):
+    """Run the selected benchmark cases and the end-to-end grid.
+
+    names limits the run to cases whose name starts with one of the given
+    prefixes. engine defaults to 'kernel' when Numba is installed.
+    Returns the results dict written by save().
+    """
+    import kernel
+
+    if engine is None:
+        engine = 'kernel' if kernel.available() else 'step'
+    selected = {'import.' + module: module for module in IMPORT_MODULES}
+    selected.update(cases)
+    for n_days in days:
+        for n_tanks in tanks:
+            name = 'run.{0}d.{1}t'.format(n_days, n_tanks)
+            selected[name] = end_to_end(n_days, n_tanks, engine)
+    if names:
+        selected = {name: setup for name, setup in selected.items()
+                    if any(name.startswith(prefix) for prefix in names)}
+
+    results = {}
+    for name, setup in selected.items():
+        # long end-to-end runs are only timed once
+        runs = 1 if name.startswith('run.') and not name.startswith('run.1d.') else repeat
+        if name.startswith('import.'):
+            results[name] = measure_import(setup, repeat=repeat)
+        else:
+            results[name] = measure(setup, repeat=runs, memory=memory, seed=seed)
+        log('{0:<24} {1:>12.6f} s  {2:>14.1f} {3}/s {4}'.format(
+            name, results[name]['best'], results[name]['throughput'] or 0, results[name]['unit'],
+            ' '.join(results[name].get('loaded', ()))))
+    return {'environment': dict(environment(), engine=engine), 'results': results}
+
+def save(results, path):
+    with open(path, 'w') as output:
+        json.dump(results, output, indent=2)
+
+def load(path):
+    with open(path, 'r') as results:
+        return json.load(results)
+
+def compare(baseline, current, threshold=0.2):
+    """Return (name, baseline s, current s, ratio) for cases more than threshold slower."""
+    regressions = []
+    for name, result in current['results'].items():
+        previous = baseline['results'].get(name)
+        if previous is None or not previous['best']:
+            continue
+        ratio = result['best']/previous['best']
+        if ratio > 1 + threshold:
+            regressions.append((name, previous['best'], result['best'], ratio))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('cases', nargs='*', help="only run cases starting with these prefixes")
+    parser.add_argument('--output', help="write the results to this JSON file")
+    parser.add_argument('--compare', help="compare against an earlier JSON results file")
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help="relative slowdown reported as a regression (default 0.2)")
+    parser.add_argument('--quick', action='store_true', help="only run the 1-day end-to-end runs")
+    parser.add_argument('--days', type=int, nargs='+', help="end-to-end run lengths")
+    parser.add_argument('--tanks', type=int, nargs='+', help="end-to-end fleet sizes")
+    parser.add_argument('--engine', choices=('step', 'kernel'))
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--no-memory', action='store_true', help="skip memory profiling")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    days = args.days or (QUICK_DAYS if args.quick else END_TO_END_DAYS)
+    tanks = args.tanks or (QUICK_TANKS if args.quick else END_TO_END_TANKS)
+    results = run_benchmarks(args.cases, days=days, tanks=tanks, engine=args.engine,
+                             repeat=args.repeat, memory=not args.no_memory, seed=args.seed)
+    if args.output:
+        save(results, args.output)
+    if args.compare:
+        regressions = compare(load(args.compare), results, args.threshold)
+        for name, previous, current, ratio in regressions:
+            print("REGRESSION {0}: {1:.4f} s -> {2:.4f} s ({3:.2f}x)".format(name, previous, current, ratio))
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
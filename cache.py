@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+"""
+Disk-backed, content-addressed cache of simulation results.
+
+ResultCache.run takes the same inputs as Simulation.run and hashes all of
+them: the Simulation settings, heater parameters and states, users, weather
+data, shower statistics, random generator state and run options. The hash
+also covers the contents of the TOML statistics files and the source of the
+simulation modules. When an entry with the same hash exists, its result
+arrays are returned memory-mapped from disk. The heater states,
+Simulation.ambient_temperature and the generator state are set to their
+values at the end of the cached run. Otherwise the run is simulated straight
+into a new entry.
+
+Every entry is a directory of .npy files named after its hash. Entries are
+written to a temporary directory and renamed into place, and are evicted by
+renaming them away before deletion. Several processes can therefore share one
+cache directory without locks: readers see either a complete entry or none.
+Two processes missing the same entry at the same time both simulate it and
+the second one keeps the first one's entry. Once the cache grows beyond
+max_bytes the least recently used entries are evicted.
+"""
+import datetime
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+import numpy as np
+import stats_registry
+
+VERSION = 1
+# modules whose source determines the simulated results
+SOURCE_MODULES = ('ewh_sim', 'fleet', 'stratified', 'kernel', 'coefficients', 'shower', 'user',
+                  'stats_registry', 'controllers', 'population', 'weather', 'results')
+# attributes holding caches or per-run bookkeeping rather than inputs
+IGNORED_ATTRIBUTES = {'ScheduleCache': ('entries', 'hits', 'misses'),
+                      'Controller': ('time_step', 'is_active', 'upper_temp_limit', 'lower_temp_limit')}
+# run options that do not affect the results
+UNHASHED_OPTIONS = ('instrumentation',)
+
+def fingerprint(value, digest, seen=None):
+    """Feed a canonical description of value into a hashlib digest.
+
+    Arrays are hashed by dtype, shape and contents, generators by their bit
+    generator state and other objects by class name, public attributes and
+    settable properties, skipping those in IGNORED_ATTRIBUTES. Objects already
+    visited (cycles such as a user's schedule pointing back to the user) are
+    hashed once.
+    """
+    if seen is None:
+        seen = set()
+    if value is None or isinstance(value, (bool, int, float, complex, str, bytes, np.generic,
+                                           datetime.date, datetime.timedelta)):
+        digest.update('{0}:{1!r};'.format(type(value).__name__, value).encode())
+    elif isinstance(value, np.ndarray):
+        if value.dtype.hasobject:
+            digest.update('object-array:{0};'.format(value.shape).encode())
+            fingerprint(value.tolist(), digest, seen)
+        else:
+            dtype = value.dtype.str if value.dtype.names is None else value.dtype.descr
+            digest.update('array:{0}:{1};'.format(dtype, value.shape).encode())
+            digest.update(np.ascontiguousarray(value).tobytes())
+    elif isinstance(value, (list, tuple)):
+        digest.update('{0}:{1};'.format(type(value).__name__, len(value)).encode())
+        for item in value:
+            fingerprint(item, digest, seen)
+    elif isinstance(value, dict):
+        digest.update('dict:{0};'.format(len(value)).encode())
+        for key in sorted(value, key=repr):
+            fingerprint(key, digest, seen)
+            fingerprint(value[key], digest, seen)
+    elif isinstance(value, np.random.Generator):
+        fingerprint(value.bit_generator.state, digest, seen)
+    elif id(value) in seen:
+        digest.update(b'seen;')
+    else:
+        seen.add(id(value))
+        cls = type(value)
+        digest.update('object:{0}.{1};'.format(cls.__module__, cls.__qualname__).encode())
+        ignored = set()
+        for base in cls.__mro__:
+            ignored.update(IGNORED_ATTRIBUTES.get(base.__name__, ()))
+        if hasattr(value, '__dict__'):
+            names = list(vars(value))
+        else:
+            names = [name for base in cls.__mro__ for name in getattr(base, '__slots__', ())]
+        # settable properties such as the EWH coefficient parameters
+        names += [name for base in cls.__mro__ for name, member in vars(base).items()
+                  if isinstance(member, property) and member.fset is not None]
+        for name in sorted(set(names)):
+            if name.startswith('_') or name in ignored or not hasattr(value, name):
+                continue
+            fingerprint(name, digest, seen)
+            fingerprint(getattr(value, name), digest, seen)
+
+def source_files():
+    """Return the paths of the statistics files and simulation modules covered by every key."""
+    directory = os.path.dirname(os.path.abspath(__file__))
+    return ([stats_registry.DIURNAL_PATH, stats_registry.SHOWER_PATH]
+            + [os.path.join(directory, module + '.py') for module in SOURCE_MODULES])
+
+def heater_states(heaters):
+    """Return the state arrays of a fleet, a heater record array or a list of EWH objects."""
+    from fleet import EWHFleet
+
+    if isinstance(heaters, np.ndarray):
+        return {name: heaters[name].copy() for name in EWHFleet.states}
+    if isinstance(heaters, EWHFleet):
+        names = heaters.states + (('node_temp',) if hasattr(heaters, 'node_temp') else ())
+        return {name: np.array(getattr(heaters, name)) for name in names}
+    return {name: np.array([getattr(ewh, name) for ewh in heaters]) for name in EWHFleet.states}
+
+def restore_states(heaters, states):
+    from fleet import EWHFleet
+
+    if isinstance(heaters, EWHFleet):
+        for name in heaters.states:
+            setattr(heaters, name, np.array(states[name]))
+        # stratified layers, set after current_temp which resets them
+        if 'node_temp' in states:
+            heaters.node_temp = np.array(states['node_temp'])
+        return
+    if isinstance(heaters, np.ndarray):
+        for name in EWHFleet.states:
+            heaters[name] = states[name]
+        return
+    for index, ewh in enumerate(heaters):
+        for name in EWHFleet.states:
+            setattr(ewh, name, states[name][index].item())
+
+class ResultCache:
+    def __init__(self, path, max_bytes=10*2**30, stale=3600):
+        """Cache results under the directory path, holding at most max_bytes.
+
+        Temporary directories older than stale seconds are assumed to be
+        left over from crashed processes and removed during eviction.
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.stale = stale
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, simulation, heaters, users, days=None, rng=None, dtypes=None, downsample=1,
+            **options):
+        """Return the hex digest of a run's inputs; see run for the arguments."""
+        digest = hashlib.sha256('ewh-result-cache:{0};'.format(VERSION).encode())
+        for path in source_files():
+            with open(path, 'rb') as source:
+                digest.update(hashlib.sha256(source.read()).digest())
+        options = {name: value for name, value in options.items() if name not in UNHASHED_OPTIONS}
+        fingerprint({'simulation': simulation, 'heaters': heaters, 'users': users,
+                     'days': simulation.days if days is None else days, 'rng': rng,
+                     'dtypes': dtypes, 'downsample': downsample, 'options': options}, digest)
+        return digest.hexdigest()[:32]
+
+    def entry(self, key):
+        return os.path.join(self.path, key)
+
+    def load(self, key):
+        """Return (results, metadata, states) of a stored entry, or None when it is missing."""
+        entry = self.entry(key)
+        try:
+            with open(os.path.join(entry, 'meta.json'), 'r') as meta_file:
+                meta = json.load(meta_file)
+            data = {name: np.load(os.path.join(entry, name + '.npy'), mmap_mode='r')
+                    for name in meta['fields']}
+            with np.load(os.path.join(entry, 'state.npz')) as stored:
+                states = {name: stored[name] for name in stored.files}
+            # mark the entry as recently used
+            os.utime(os.path.join(entry, 'meta.json'))
+        except (FileNotFoundError, NotADirectoryError):
+            # missing, or evicted by another process while loading
+            return None
+        return data, meta, states
+
+    def run(self, simulation, heaters, users, days=None, rng=None, dtypes=None, downsample=1,
+            **options):
+        """Return the results of simulation.run(heaters, users, ...), from the cache when possible.
+
+        rng is the numpy.random.Generator used for shower sampling and is
+        required unless options has population draws. dtypes and downsample
+        configure the results.ResultBuffer the run is stored in. Other options
+        (weather, shower, schedules, start_date, engine, controller, draws,
+        instrumentation) are passed to Simulation.run. Returns a dict of
+        read-only memory-mapped arrays.
+        """
+        import ewh_sim
+        from results import ResultBuffer
+
+        if 'results' in options or 'checkpoint' in options:
+            raise ValueError("cached runs store their own results and cannot be checkpointed")
+        if rng is None and options.get('draws') is None:
+            raise ValueError("cached runs need an rng to be reproducible")
+        if isinstance(heaters, ewh_sim.HEATER_TYPES):
+            heaters = [heaters]
+        if days is None:
+            days = simulation.days
+        key = self.key(simulation, heaters, users, days=days, rng=rng, dtypes=dtypes,
+                       downsample=downsample, **options)
+        stored = self.load(key)
+        if stored is not None:
+            self.hits += 1
+            data, meta, states = stored
+            restore_states(heaters, states)
+            simulation.ambient_temperature = meta['ambient_temperature']
+            if rng is not None:
+                rng.bit_generator.state = meta['rng_state']
+            return data
+
+        self.misses += 1
+        os.makedirs(self.path, exist_ok=True)
+        temporary = os.path.join(self.path, 'tmp-' + uuid.uuid4().hex)
+        try:
+            tanks = len(heaters)
+            results = ResultBuffer(int(86400/simulation.time_step)*days, tanks, days=days,
+                                   dtypes=dtypes, downsample=downsample, path=temporary)
+            simulation.run(heaters, users, days=days, rng=rng, results=results, **options)
+            fields = list(results.data)
+            # release the memory maps so the directory can be renamed on every platform
+            del results
+            np.savez(os.path.join(temporary, 'state.npz'), **heater_states(heaters))
+            meta = {'key': key, 'fields': fields, 'days': days, 'tanks': tanks,
+                    'created': time.time(), 'ambient_temperature': float(simulation.ambient_temperature),
+                    'rng_state': None if rng is None else rng.bit_generator.state}
+            with open(os.path.join(temporary, 'meta.json'), 'w') as meta_file:
+                json.dump(meta, meta_file)
+            try:
+                os.rename(temporary, self.entry(key))
+            except OSError:
+                # another process stored the same entry first
+                if not os.path.isdir(self.entry(key)):
+                    raise
+        finally:
+            shutil.rmtree(temporary, ignore_errors=True)
+        self.evict(keep=key)
+        stored = self.load(key)
+        if stored is None:
+            raise RuntimeError("result cache entry {0} was evicted while storing it".format(key))
+        return stored[0]
+
+    def entries(self):
+        """Return (key, bytes, last used time) of every stored entry, least recently used first."""
+        if not os.path.isdir(self.path):
+            return []
+        entries = []
+        for name in os.listdir(self.path):
+            entry = self.entry(name)
+            try:
+                used = os.path.getmtime(os.path.join(entry, 'meta.json'))
+                size = sum(os.path.getsize(os.path.join(entry, filename)) for filename in os.listdir(entry))
+            except (FileNotFoundError, NotADirectoryError):
+                # temporary directories and entries being evicted
+                continue
+            entries.append((name, size, used))
+        return sorted(entries, key=lambda entry: entry[2])
+
+    def nbytes(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def remove(self, key):
+        """Remove an entry, returning False when it is gone or still in use."""
+        trash = os.path.join(self.path, 'trash-' + uuid.uuid4().hex)
+        try:
+            os.rename(self.entry(key), trash)
+        except OSError:
+            # already evicted by another process, or memory-mapped on Windows
+            return False
+        shutil.rmtree(trash, ignore_errors=True)
+        return True
+
+    def evict(self, keep=None):
+        """Remove the least recently used entries until the cache fits in max_bytes.
+
+        The entry `keep` is never removed. Also removes stale temporary
+        directories left by crashed processes.
+        """
+        now = time.time()
+        for name in os.listdir(self.path) if os.path.isdir(self.path) else ():
+            if name.startswith(('tmp-', 'trash-')):
+                entry = self.entry(name)
+                try:
+                    if now - os.path.getmtime(entry) > self.stale:
+                        shutil.rmtree(entry, ignore_errors=True)
+                except OSError:
+                    pass
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for key, size, _ in entries:
+            if total <= self.max_bytes:
+                break
+            if key != keep and self.remove(key):
+                total -= size
+
+    def clear(self):
+        for key, _, _ in self.entries():
+            self.remove(key)
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+"""
+Process-wide table of per-time-step thermal coefficients.
+
+The standing loss decay factor, the element temperature gain and the draw
+mixing factor of a heater depend only on its mass, thermal conductance,
+element rating and volume, the time step and the draw intensity. They are
+computed once per distinct combination and shared by every heater with the
+same configuration, so each update reduces to multiply-adds:
+
+    standing loss   T = ambient + (T - ambient)*decay
+    element         T = heat_gain + T
+    draw            T = sigma*(T - inlet_temp) + inlet_temp
+
+The values are computed with the same expressions as the EWH methods, so
+results are unchanged.
+"""
+import math
+from collections import namedtuple
+
+Coefficients = namedtuple('Coefficients', ('decay', 'heat_gain', 'sigma'))
+
+# (mass, thermal_conduct, element_rating, volume, time_step, intensity) -> Coefficients
+_table = {}
+
+def lookup(mass, thermal_conduct, element_rating, volume, time_step, intensity=0.0):
+    """Return the Coefficients of a heater configuration for one time step.
+
+    sigma is the mixing factor of drawing `intensity` l/s for time_step seconds.
+    """
+    key = (mass, thermal_conduct, element_rating, volume, time_step, intensity)
+    entry = _table.get(key)
+    if entry is None:
+        from ewh_sim import specific_heat_cap
+
+        alpha = (-1*time_step)/(specific_heat_cap*mass*thermal_conduct)
+        entry = Coefficients(math.exp(alpha), (element_rating * time_step)/(specific_heat_cap*mass),
+                             (volume - (intensity*time_step))/volume)
+        _table[key] = entry
+    return entry
+
+def clear():
+    _table.clear()
+
+def size():
+    return len(_table)
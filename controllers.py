@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+Demand-side management controllers.
+
+A controller is handed to Simulation.run and called every `interval` time
+steps with the absolute step index and the fleet.EWHFleet being simulated. It
+returns per-tank (enable, upper_temp_limit, lower_temp_limit) vectors, any of
+which may be None to leave that setting unchanged. Disabled tanks behave like
+an EWH with is_active False: the element cannot heat. Controllers work on
+whole fleet arrays at once, never on individual heaters.
+"""
+import numpy as np
+
+class Controller:
+    # number of time steps between control decisions
+    interval = 1
+
+    def reset(self, fleet, time_step):
+        """Record the fleet's baseline settings at the start of a run."""
+        self.time_step = time_step
+        self.is_active = np.array(fleet.is_active, dtype=bool)
+        self.upper_temp_limit = np.array(fleet.upper_temp_limit, dtype=np.float64)
+        self.lower_temp_limit = np.array(fleet.lower_temp_limit, dtype=np.float64)
+
+    def control(self, step, fleet):
+        """Return (enable, upper_temp_limit, lower_temp_limit) arrays for the coming steps."""
+        raise NotImplementedError
+
+    def apply(self, step, fleet):
+        enable, upper_temp_limit, lower_temp_limit = self.control(step, fleet)
+        if enable is not None:
+            fleet.is_active = self.is_active & np.broadcast_to(enable, self.is_active.shape)
+        if upper_temp_limit is not None:
+            fleet.upper_temp_limit = np.broadcast_to(upper_temp_limit, self.upper_temp_limit.shape).astype(np.float64)
+        if lower_temp_limit is not None:
+            fleet.lower_temp_limit = np.broadcast_to(lower_temp_limit, self.lower_temp_limit.shape).astype(np.float64)
+
+    def seconds(self, step):
+        return step * self.time_step
+
+def in_windows(time, windows):
+    """Return True where time (seconds, array) falls in any [start, end) window, wrapping at midnight."""
+    time = np.asarray(time)[..., None]
+    start = np.array([window[0] for window in windows], dtype=np.float64)
+    end = np.array([window[1] for window in windows], dtype=np.float64)
+    inside = np.where(start < end, (time >= start) & (time < end), (time >= start) | (time < end))
+    return inside.any(axis=-1)
+
+class TimeOfUseController(Controller):
+    """Block or set back heating during fixed daily time-of-use windows.
+
+    blocks is a list of (start_hour, end_hour) windows; a window with
+    start > end wraps past midnight. stagger gives each tank an offset in
+    minutes (scalar or array) to spread the rebound peak. With setback=None
+    the element is disabled in a block, otherwise both setpoints are lowered
+    by setback degrees.
+    """
+
+    def __init__(self, blocks=((17, 20),), stagger=0, setback=None, interval=1):
+        self.blocks = [(start*3600, end*3600) for start, end in blocks]
+        self.stagger = stagger
+        self.setback = setback
+        self.interval = interval
+
+    def control(self, step, fleet):
+        time_of_day = (self.seconds(step) - np.asarray(self.stagger)*60) % 86400
+        blocked = np.broadcast_to(in_windows(time_of_day, self.blocks), self.is_active.shape)
+        if self.setback is None:
+            return ~blocked, None, None
+        return (None, np.where(blocked, self.upper_temp_limit - self.setback, self.upper_temp_limit),
+                np.where(blocked, self.lower_temp_limit - self.setback, self.lower_temp_limit))
+
+class RippleController(Controller):
+    """Switch groups of tanks off with ripple-control style commands.
+
+    groups gives the ripple group of every tank. commands is a list of
+    (start_hour, end_hour, group) off commands counted from the start of
+    the simulation, or from midnight every day when daily is True.
+    """
+
+    def __init__(self, groups, commands, daily=False, interval=1):
+        self.groups = np.asarray(groups)
+        self.commands = list(commands)
+        self.daily = daily
+        self.interval = interval
+
+    def control(self, step, fleet):
+        time = self.seconds(step)
+        if self.daily:
+            time = time % 86400
+        enable = np.ones(len(self.groups), dtype=bool)
+        for start, end, group in self.commands:
+            if start*3600 <= time < end*3600:
+                enable &= self.groups != group
+        return enable, None, None
+
+class PriceResponsiveController(Controller):
+    """Shed heating when the price is high and pre-heat when it is low.
+
+    prices is a sequence of hourly prices counted from the start of the
+    simulation (wrapping around). Tanks are disabled while the price is
+    above their shed_price (scalar or per-tank array) unless they have
+    fallen below min_temp, and their setpoints are raised by boost degrees
+    while the price is below boost_price.
+    """
+
+    def __init__(self, prices, shed_price, boost_price=None, boost=5.0, min_temp=45.0, interval=1):
+        self.prices = np.asarray(prices, dtype=np.float64)
+        self.shed_price = shed_price
+        self.boost_price = boost_price
+        self.boost = boost
+        self.min_temp = min_temp
+        self.interval = interval
+
+    def price(self, step):
+        return self.prices[int(self.seconds(step)//3600) % len(self.prices)]
+
+    def control(self, step, fleet):
+        price = self.price(step)
+        enable = (price <= np.asarray(self.shed_price)) | (fleet.current_temp < self.min_temp)
+        if self.boost_price is None or price >= self.boost_price:
+            return enable, self.upper_temp_limit, self.lower_temp_limit
+        return enable, self.upper_temp_limit + self.boost, self.lower_temp_limit + self.boost
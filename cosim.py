@@ -0,0 +1,384 @@
+# -*- coding: utf-8 -*-
+"""
+Co-simulation server streaming fleet state to an external DSM controller.
+
+CoSimServer runs Simulation.run in a worker thread with a RemoteController.
+At every control decision (every `interval` time steps) the controller sends a
+snapshot of the fleet to the one client connected over a local TCP socket and
+applies the commands the client sends back, like any other
+controllers.Controller. The asyncio event loop does the socket I/O.
+
+Every message is a frame: a FRAME header (kind, flags, step, payload length)
+followed by the payload, little-endian throughout.
+
+    HELLO     JSON: tanks, time_step, interval, window, days and pace
+    SNAPSHOT  current_temp as float32[tanks], then element_on and is_active
+              as np.packbits bit vectors. step is the time step about to be
+              simulated and is_active the enable setting currently in force.
+    COMMAND   enable bits (flags & ENABLE), upper_temp_limit float32[tanks]
+              (flags & UPPER) and lower_temp_limit float32[tanks]
+              (flags & LOWER), each only when flagged, in that order. A
+              command without flags keeps the current settings.
+    END       JSON run summary, sent before the server closes the connection
+
+Flow control is credit based: every COMMAND answers one SNAPSHOT, and the
+simulation waits while `window` snapshots are unanswered. With window=1 it runs
+in lockstep with the client and each command applies from the step of the
+snapshot it answers; larger windows pipeline decisions, and commands then apply
+from the first decision after they arrive. Frames are only written once the
+socket has drained the previous ones.
+
+With pace=None the simulation runs as fast as the client allows. Otherwise it
+runs at `pace` times wall-clock speed (1.0 for real time), and decisions
+starting behind schedule are counted in the summary.
+
+stub_controller is a client that can stand in for the aggregator, driven by a
+policy function, and run_with_stub runs a server against it in one event loop.
+"""
+import argparse
+import asyncio
+import functools
+import json
+import queue
+import struct
+import sys
+import time
+import numpy as np
+import ewh_sim
+from controllers import Controller
+
+# kind, flags, step, payload bytes
+FRAME = struct.Struct('<cBqI')
+HELLO, SNAPSHOT, COMMAND, END = b'H', b'S', b'C', b'E'
+# COMMAND flags
+ENABLE, UPPER, LOWER = 1, 2, 4
+
+def pack(kind, step=0, payload=b'', flags=0):
+    return FRAME.pack(kind, flags, step, len(payload)) + payload
+
+async def read_frame(reader):
+    """Return (kind, flags, step, payload) of the next frame, or None once the peer has closed."""
+    try:
+        kind, flags, step, length = FRAME.unpack(await reader.readexactly(FRAME.size))
+        return kind, flags, step, await reader.readexactly(length)
+    except (asyncio.IncompleteReadError, ConnectionResetError):
+        return None
+
+def encode_snapshot(fleet):
+    return b''.join((np.asarray(fleet.current_temp, dtype='<f4').tobytes(),
+                     np.packbits(fleet.element_on).tobytes(),
+                     np.packbits(fleet.is_active).tobytes()))
+
+def decode_snapshot(payload, tanks):
+    """Return the (temperature, element_on, is_active) arrays of a SNAPSHOT payload."""
+    bits = -(-tanks//8)
+    temperature = np.frombuffer(payload, dtype='<f4', count=tanks)
+    packed = np.frombuffer(payload, dtype=np.uint8, offset=4*tanks)
+    element_on = np.unpackbits(packed[:bits], count=tanks).astype(bool)
+    is_active = np.unpackbits(packed[bits:], count=tanks).astype(bool)
+    return temperature, element_on, is_active
+
+def encode_command(tanks, enable=None, upper_temp_limit=None, lower_temp_limit=None):
+    """Return the (flags, payload) of a COMMAND; scalars apply to every tank."""
+    flags = 0
+    parts = []
+    if enable is not None:
+        flags |= ENABLE
+        parts.append(np.packbits(np.broadcast_to(np.asarray(enable, dtype=bool), (tanks,))).tobytes())
+    for flag, limit in ((UPPER, upper_temp_limit), (LOWER, lower_temp_limit)):
+        if limit is not None:
+            flags |= flag
+            parts.append(np.broadcast_to(np.asarray(limit, dtype='<f4'), (tanks,)).tobytes())
+    return flags, b''.join(parts)
+
+def decode_command(flags, payload, tanks):
+    """Return the (enable, upper_temp_limit, lower_temp_limit) of a COMMAND, None where not sent."""
+    bits = -(-tanks//8)
+    expected = (bits if flags & ENABLE else 0) + 4*tanks*(bool(flags & UPPER) + bool(flags & LOWER))
+    if len(payload) != expected:
+        raise ValueError("expected a {0} byte command for {1} tanks, got {2} bytes"
+                         .format(expected, tanks, len(payload)))
+    enable = upper_temp_limit = lower_temp_limit = None
+    offset = 0
+    if flags & ENABLE:
+        enable = np.unpackbits(np.frombuffer(payload, dtype=np.uint8, count=bits), count=tanks).astype(bool)
+        offset = bits
+    if flags & UPPER:
+        upper_temp_limit = np.frombuffer(payload, dtype='<f4', count=tanks, offset=offset)
+        offset += 4*tanks
+    if flags & LOWER:
+        lower_temp_limit = np.frombuffer(payload, dtype='<f4', count=tanks, offset=offset)
+    return enable, upper_temp_limit, lower_temp_limit
+
+class RemoteController(Controller):
+    """Send a SNAPSHOT frame every decision and apply the commands delivered to `commands`.
+
+    send is called from the simulation thread with every frame. Commands are
+    (enable, upper_temp_limit, lower_temp_limit) tuples put on the thread-safe
+    commands queue; later commands override earlier ones field by field.
+    timeout bounds the wait for a command in seconds.
+    """
+
+    def __init__(self, send, interval=1, window=1, pace=None, timeout=None):
+        self.send = send
+        self.interval = interval
+        self.window = max(int(window), 1)
+        self.pace = pace
+        self.timeout = timeout
+        self.commands = queue.Queue()
+        self.closed = False
+
+    def reset(self, fleet, time_step):
+        super().reset(fleet, time_step)
+        # unanswered snapshots
+        self.pending = 0
+        self.decisions = 0
+        self.late = 0
+        self.max_lag = 0.0
+        self.started = None
+        self.first_step = None
+
+    def close(self):
+        """Fail the next decision, or the one waiting for a command, with ConnectionError."""
+        self.closed = True
+        self.commands.put(None)
+
+    def wait(self, step):
+        """Sleep until the wall-clock time of `step` at the configured pace."""
+        now = time.perf_counter()
+        if self.started is None:
+            self.started, self.first_step = now, step
+        delay = self.started + (step - self.first_step)*self.time_step/self.pace - now
+        if delay > 0:
+            time.sleep(delay)
+        elif delay < 0:
+            self.late += 1
+            self.max_lag = max(self.max_lag, -delay)
+
+    def control(self, step, fleet):
+        if self.closed:
+            raise ConnectionError("the co-simulation client disconnected")
+        if self.pace is not None:
+            self.wait(step)
+        self.send(pack(SNAPSHOT, step, encode_snapshot(fleet)))
+        self.pending += 1
+        self.decisions += 1
+        settings = (None, None, None)
+        while True:
+            block = self.pending >= self.window
+            try:
+                command = self.commands.get(block=block, timeout=self.timeout if block else None)
+            except queue.Empty:
+                if block:
+                    raise TimeoutError("no command from the co-simulation client within {0} s"
+                                       .format(self.timeout))
+                break
+            if command is None:
+                raise ConnectionError("the co-simulation client disconnected")
+            self.pending -= 1
+            settings = tuple(setting if new is None else new for setting, new in zip(settings, command))
+        return settings
+
+    def summary(self):
+        return {'decisions': self.decisions, 'late': self.late, 'max_lag': self.max_lag}
+
+class CoSimServer:
+    """Serve one simulation run to the first client connecting to (host, port).
+
+    heaters and users are as for Simulation.run; days defaults to
+    simulation.days. interval, window, pace and timeout configure the
+    RemoteController. Other options are passed to Simulation.run. results
+    default to a results.FleetAggregator with one row per minute, as a
+    ResultBuffer of a large fleet at 1 s steps outgrows memory within hours.
+    """
+
+    def __init__(self, simulation, heaters, users, days=None, host='127.0.0.1', port=0, interval=1,
+                 window=1, pace=None, timeout=None, **options):
+        if isinstance(heaters, ewh_sim.HEATER_TYPES):
+            heaters = [heaters]
+        self.simulation = simulation
+        self.heaters = heaters
+        self.users = users
+        self.days = simulation.days if days is None else days
+        self.host = host
+        self.port = port
+        self.interval = interval
+        self.window = window
+        self.pace = pace
+        self.timeout = timeout
+        self.options = options
+        self.server = None
+        self.address = None
+        self.summary = None
+
+    async def start(self):
+        """Start listening and return the (host, port) address; port 0 lets the OS choose."""
+        self.client = asyncio.get_running_loop().create_future()
+        self.server = await asyncio.start_server(self._connected, self.host, self.port)
+        self.address = self.server.sockets[0].getsockname()[:2]
+        return self.address
+
+    def _connected(self, reader, writer):
+        if self.client.done():
+            # one controller per run
+            writer.close()
+            return
+        self.client.set_result((reader, writer))
+
+    async def _send(self, outgoing, writer):
+        while True:
+            frame = await outgoing.get()
+            if frame is None:
+                return
+            writer.write(frame)
+            await writer.drain()
+
+    async def _receive(self, reader, controller, tanks):
+        try:
+            while True:
+                frame = await read_frame(reader)
+                if frame is None:
+                    return
+                kind, flags, _, payload = frame
+                if kind != COMMAND:
+                    raise ValueError("expected a command frame, got {0!r}".format(kind))
+                controller.commands.put(decode_command(flags, payload, tanks))
+        finally:
+            controller.close()
+
+    async def serve(self):
+        """Wait for a client, run the simulation against it and return the results' arrays."""
+        from results import FleetAggregator
+
+        if self.server is None:
+            await self.start()
+        loop = asyncio.get_running_loop()
+        reader, writer = await self.client
+        tanks = len(self.heaters)
+        time_step = self.simulation.time_step
+        options = dict(self.options)
+        if options.get('results') is None:
+            options['results'] = FleetAggregator(int(86400/time_step)*self.days, interval=max(60//time_step, 1),
+                                                 time_step=time_step, days=self.days)
+        outgoing = asyncio.Queue()
+        controller = RemoteController(functools.partial(loop.call_soon_threadsafe, outgoing.put_nowait),
+                                      interval=self.interval, window=self.window, pace=self.pace,
+                                      timeout=self.timeout)
+        hello = {'tanks': tanks, 'time_step': time_step, 'interval': self.interval, 'window': self.window,
+                 'days': self.days, 'pace': self.pace}
+        outgoing.put_nowait(pack(HELLO, payload=json.dumps(hello).encode()))
+        sender = asyncio.ensure_future(self._send(outgoing, writer))
+        receiver = asyncio.ensure_future(self._receive(reader, controller, tanks))
+        started = time.perf_counter()
+        try:
+            try:
+                data = await loop.run_in_executor(None, functools.partial(
+                    self.simulation.run, self.heaters, self.users, days=self.days, controller=controller,
+                    **options))
+            except ConnectionError as error:
+                # report a malformed frame rather than the disconnect it caused
+                if receiver.done() and not receiver.cancelled() and receiver.exception() is not None:
+                    raise receiver.exception() from error
+                raise
+            self.summary = dict(controller.summary(), seconds=time.perf_counter() - started)
+            outgoing.put_nowait(pack(END, payload=json.dumps(self.summary).encode()))
+            outgoing.put_nowait(None)
+            await sender
+        finally:
+            # stops the simulation thread at its next decision when the run was interrupted
+            controller.close()
+            sender.cancel()
+            receiver.cancel()
+            writer.close()
+            self.server.close()
+        return data
+
+async def stub_controller(host, port, policy=None):
+    """Connect to a CoSimServer in place of the aggregator and answer every snapshot.
+
+    policy(step, temperature, element_on, is_active) returns the (enable,
+    upper_temp_limit, lower_temp_limit) command for a snapshot, any of which
+    may be None to keep that setting; without a policy every command keeps
+    the current settings. Returns the server's run summary.
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        frame = await read_frame(reader)
+        if frame is None or frame[0] != HELLO:
+            raise ConnectionError("the co-simulation server did not say hello")
+        tanks = json.loads(frame[3])['tanks']
+        while True:
+            frame = await read_frame(reader)
+            if frame is None:
+                raise ConnectionError("the co-simulation server closed the connection")
+            kind, _, step, payload = frame
+            if kind == END:
+                return json.loads(payload)
+            command = (None, None, None) if policy is None else policy(step, *decode_snapshot(payload, tanks))
+            flags, payload = encode_command(tanks, *command)
+            writer.write(pack(COMMAND, step, payload, flags))
+            await writer.drain()
+    finally:
+        writer.close()
+
+def coldest_first(limit):
+    """Return a stub policy enabling only the `limit` coldest tanks."""
+    def policy(step, temperature, element_on, is_active):
+        enable = np.zeros(len(temperature), dtype=bool)
+        if limit >= len(temperature):
+            enable[:] = True
+        elif limit > 0:
+            enable[np.argpartition(temperature, limit - 1)[:limit]] = True
+        return enable, None, None
+    return policy
+
+def run_with_stub(simulation, heaters, users, policy=None, **options):
+    """Run a CoSimServer against a local stub_controller; returns (results, summary)."""
+    async def main():
+        server = CoSimServer(simulation, heaters, users, **options)
+        host, port = await server.start()
+        client = asyncio.ensure_future(stub_controller(host, port, policy))
+        data = await server.serve()
+        return data, await client
+    return asyncio.run(main())
+
+def main(argv=None):
+    import fleet
+    import population
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--tanks', type=int, default=10000)
+    parser.add_argument('--days', type=int, default=1)
+    parser.add_argument('--time-step', type=int, default=1)
+    parser.add_argument('--interval', type=int, default=1, help="time steps between decisions")
+    parser.add_argument('--window', type=int, default=1, help="unanswered snapshots before waiting")
+    parser.add_argument('--pace', type=float, help="multiple of wall-clock speed (default: unpaced)")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=0)
+    parser.add_argument('--stub', action='store_true', help="answer with an in-process stub controller")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    rng = np.random.default_rng(args.seed)
+    heaters = fleet.EWHFleet(args.tanks, always_on=True)
+    heaters.randomise_settings(rng)
+    draws = population.generate(args.tanks, days=args.days, seed=args.seed).draws
+    simulation = ewh_sim.Simulation(time_step=args.time_step)
+
+    async def serve():
+        server = CoSimServer(simulation, heaters, None, days=args.days, host=args.host, port=args.port,
+                             interval=args.interval, window=args.window, pace=args.pace, draws=draws)
+        host, port = await server.start()
+        print("co-simulation of {0} tanks listening on {1}:{2}".format(args.tanks, host, port))
+        client = asyncio.ensure_future(stub_controller(host, port)) if args.stub else None
+        await server.serve()
+        if client is not None:
+            await client
+        return server.summary
+
+    summary = asyncio.run(serve())
+    print("{decisions} decisions in {seconds:.1f} s, {late} late (max lag {max_lag:.3f} s)".format(**summary))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+Event-driven time stepping for EWHs.
+
+Within a segment of constant ambient temperature and draw rate, each time step
+of the simulation loop is an affine map of the tank temperature
+
+    y = c*T + b           (standing loss followed by any draw loss)
+    T' = y + g            (if the element heats during the step, else T' = y)
+
+so k steps can be evaluated in closed form and the step at which the
+thermostat switches the element can be solved for directly. A heater is only
+touched at events: draw start/end, hourly ambient changes and thermostat
+crossings. The per-step trace is reconstructed from the closed form only when
+requested.
+"""
+import math
+
+def first_crossing(offset, delta, c, threshold, below, steps):
+    """Return the first k in [0, steps) where offset + delta*c**(k+1) crosses threshold.
+
+    The crossing is `< threshold` when below is True and `>= threshold`
+    otherwise. The sequence is monotonic in k, so the log estimate is exact up
+    to rounding and only nudged by a step to honour the strict comparison.
+    Returns None if no crossing happens within the segment.
+    """
+    def crossed(k):
+        value = offset + delta*c**(k+1)
+        return value < threshold if below else value >= threshold
+
+    if steps <= 0:
+        return None
+    if crossed(0):
+        return 0
+    if delta == 0 or not crossed(steps - 1):
+        return None
+    # solve offset + delta*c**(x+1) = threshold for x
+    ratio = (threshold - offset)/delta
+    k = int(math.log(ratio)/math.log(c)) - 1 if ratio > 0 else steps - 1
+    k = min(max(k, 0), steps - 1)
+    while k > 0 and crossed(k - 1):
+        k -= 1
+    while not crossed(k):
+        k += 1
+    return k
+
+def advance(ewh, ambient_temperature, periods, time_step, draw_rate=0.0, decay=None, trace=None):
+    """Advance a scalar EWH by `periods` time steps of constant conditions.
+
+    Matches the per-step update of fleet.EWHFleet.step (standing loss, draw
+    loss at draw_rate l/s, element hysteresis) but jumps between thermostat
+    events analytically. If trace is a (temperature, power) pair of lists
+    they are extended with the per-step values. Returns the element energy
+    used in J.
+    """
+    coefficients = ewh.coefficients(time_step)
+    if decay is None:
+        decay = coefficients.decay
+    # y = c*T + b for one step of standing (and draw) loss
+    c = decay
+    b = ambient_temperature*(1 - decay)
+    if draw_rate > 0:
+        # the draw runs for the whole time step
+        sigma = ewh.coefficients(time_step, draw_rate).sigma
+        c = sigma*c
+        b = sigma*b + ewh.inlet_temp*(1 - sigma)
+    g = coefficients.heat_gain
+    ewh.draw_event = draw_rate > 0
+
+    energy = 0.0
+    remaining = periods
+    while remaining > 0:
+        heating = ewh.is_active and ewh.element_on
+        gain = g if heating else 0.0
+        # fixed point of the current mode; T_k = fixed + (T_0 - fixed)*c**k
+        fixed = (b + gain)/(1 - c)
+        delta = ewh.current_temp - fixed
+        if not ewh.is_active:
+            k = None
+        elif heating:
+            # element switches off at the first step whose loss value reaches the upper limit
+            k = first_crossing(fixed - gain, delta, c, ewh.upper_temp_limit, False, remaining)
+        else:
+            # element switches on at the first step whose loss value falls below the lower limit
+            k = first_crossing(fixed, delta, c, ewh.lower_temp_limit, True, remaining)
+        run = remaining if k is None else k
+
+        if trace is not None:
+            power = ewh.element_rating if heating else 0.0
+            trace[0].extend(fixed + delta*c**j for j in range(1, run + 1))
+            trace[1].extend([power] * run)
+        if heating:
+            energy += ewh.element_rating * time_step * run
+        ewh.current_temp = fixed + delta*c**run
+        remaining -= run
+        if k is None:
+            break
+
+        # apply the switching step itself
+        ewh.current_temp = c*ewh.current_temp + b
+        ewh.element_on = not heating
+        if ewh.element_on:
+            ewh.current_temp += g
+            energy += ewh.element_rating * time_step
+        if trace is not None:
+            trace[0].append(ewh.current_temp)
+            trace[1].append(ewh.element_rating if ewh.element_on else 0.0)
+        remaining -= 1
+    return energy
+
+def step_draws(start, end, intensity, time_step, offset=0):
+    """Return the (start, end, rate) step ranges of a draw from minute start to minute end.
+
+    Steps only partly covered by the draw get its mean rate over the step, so
+    the drawn volume does not depend on the time step. offset is added to
+    every step index.
+    """
+    start, end = start*60, end*60
+    if end <= start:
+        return []
+    # the steps fully covered by the draw are [full_start, full_end)
+    full_start = -(-start//time_step)
+    full_end = end//time_step
+    if full_start > full_end:
+        # the draw lies within a single step
+        return [(full_end + offset, full_end + 1 + offset, intensity*(end - start)/time_step)]
+    draws = []
+    if start < full_start*time_step:
+        draws.append((full_start - 1 + offset, full_start + offset,
+                      intensity*(full_start*time_step - start)/time_step))
+    if full_start < full_end:
+        draws.append((full_start + offset, full_end + offset, intensity))
+    if end > full_end*time_step:
+        draws.append((full_end + offset, full_end + 1 + offset,
+                      intensity*(end - full_end*time_step)/time_step))
+    return draws
+
+def segment_bounds(periods, time_step, draws):
+    """Return the sorted event periods splitting [0, periods) into constant segments.
+
+    Besides the draw bounds, a segment starts at the first step of every hour,
+    counted in absolute seconds so time steps need not divide an hour.
+    """
+    hours = -(-periods*time_step//3600)
+    bounds = {-(-hour*3600//time_step) for hour in range(hours)}
+    for start, end, _ in draws:
+        bounds.update((min(max(start, 0), periods), min(max(end, 0), periods)))
+    bounds.add(periods)
+    return sorted(bounds)
+
+def simulate(ewh, draws, periods, time_step, weather=None,
+             ambient_temperature=25.2, trace=False):
+    """Run a scalar EWH over `periods` steps using event-driven stepping.
+
+    draws is a list of (start, end, intensity) tuples in absolute periods,
+    weather a sequence of hourly ambient temperatures (wrapping) or None for
+    a constant ambient_temperature. Returns (energy, trace) where trace is a
+    (temperature, power, draw) tuple of per-step lists if requested, else None.
+    """
+    # later draws take priority where two draws overlap
+    draws = sorted(draws)
+    bounds = segment_bounds(periods, time_step, draws)
+    decay = ewh.coefficients(time_step).decay
+    traces = ([], []) if trace else None
+    draw_trace = [] if trace else None
+
+    energy = 0.0
+    draw_index = 0
+    active = []
+    for seg_start, seg_end in zip(bounds[:-1], bounds[1:]):
+        while draw_index < len(draws) and draws[draw_index][0] <= seg_start:
+            active.append(draws[draw_index])
+            draw_index += 1
+        active = [draw for draw in active if draw[1] > seg_start]
+        rate = active[-1][2] if active else 0.0
+        if weather is not None:
+            # the temperature of the hour the segment starts in, as WeatherSource.profile
+            ambient_temperature = weather[(seg_start*time_step//3600) % len(weather)]
+        energy += advance(ewh, ambient_temperature, seg_end - seg_start, time_step,
+                          draw_rate=rate, decay=decay, trace=traces)
+        if trace:
+            draw_trace.extend([rate*60] * (seg_end - seg_start))
+    if trace:
+        return energy, (traces[0], traces[1], draw_trace)
+    return energy, None
@@ -4,11 +4,31 @@ Created on Tue Apr  4 10:35:00 2023
 
 @author: Kyppy
 """
-import math
+import operator
 import random
+import coefficients
 specific_heat_cap = 4180
+# most (steps, tanks) values per kernel call, bounding the memory of the kernel engines
+KERNEL_BLOCK_VALUES = 2**22
+
+def configuration(name):
+    """Return a property for a parameter the coefficients depend on.
+
+    The value is stored as _<name>, and assigning it drops the heater's
+    memoised coefficients, which are only allocated once the heater is stepped.
+    """
+    def set_parameter(self, value):
+        setattr(self, '_' + name, value)
+        self._coefficients = None
+    return property(operator.attrgetter('_' + name), set_parameter)
 
 class EWH: 
+    # parameters of the thermal coefficients, memoised per time step (and draw rate)
+    element_rating = configuration('element_rating')
+    mass = configuration('mass')
+    thermal_conduct = configuration('thermal_conduct')
+    volume = configuration('volume')
+    
     def __init__(self, always_on=False, element_rating=3000, draw_rate=15, 
                  inlet_temp=25, mass=150, randomised=False, thermal_conduct=0.341, 
                  upper_temp_limit=60, lower_temp_limit=50, volume=150):
@@ -35,31 +55,130 @@ class EWH:
     def calculate_power(self, delta_temp, time_step):
         return ((self.mass * specific_heat_cap * delta_temp)/time_step)
     
-    def draw_event_loss (self, draw_rate=None, time_step=60):
+    def coefficients(self, time_step, intensity=0.0):
+        """Return the shared (decay, heat_gain, sigma) coefficients of this configuration.
+
+        The entry is looked up once per time step and draw intensity and then
+        memoised on the heater until one of its parameters is assigned.
+        """
+        key = time_step if intensity == 0.0 else (time_step, intensity)
+        try:
+            return self._coefficients[key]
+        except KeyError:
+            pass
+        except (AttributeError, TypeError):
+            self._coefficients = {}
+        entry = self._coefficients[key] = coefficients.lookup(
+            self.mass, self.thermal_conduct, self.element_rating, self.volume, time_step, intensity)
+        return entry
+    
+    def draw_event_loss (self, draw_rate=None, *, time_step):
         if draw_rate is None:
             draw_rate = self.draw_rate
-        sigma = (self.volume - (draw_rate*time_step))/self.volume
+        # the mixing factor is cheaper to compute than to look up, as in coefficients.lookup
+        volume = self._volume
+        sigma = (volume - (draw_rate*time_step))/volume
         return sigma * (self.current_temp - self.inlet_temp) + self.inlet_temp
     
-    def initialise_temp(self):
-        self.element_on = random.choices([True, False], [0.04, 0.96], k=1)[0]
-        self.current_temp = round(random.uniform(self.lower_temp_limit, self.upper_temp_limit), 2)
+    def initialise_temp(self, rng=None):
+        # rng is an optional numpy.random.Generator, the global random state is used otherwise
+        if rng is None:
+            self.element_on = random.choices([True, False], [0.04, 0.96], k=1)[0]
+            self.current_temp = round(random.uniform(self.lower_temp_limit, self.upper_temp_limit), 2)
+        else:
+            self.element_on = bool(rng.random() < 0.04)
+            self.current_temp = round(float(rng.uniform(self.lower_temp_limit, self.upper_temp_limit)), 2)
         
     def increase_temp(self, time_step):
-        energy = self.element_rating * time_step
-        return (energy)/(specific_heat_cap*self.mass) + self.current_temp
+        try:
+            heat_gain = self._coefficients[time_step].heat_gain
+        except (AttributeError, KeyError, TypeError):
+            heat_gain = self.coefficients(time_step).heat_gain
+        return heat_gain + self.current_temp
     
-    def randomise_settings(self):
-        self.element_rating = random.choice([2000, 3000, 4000])
-        self.mass = random.choice([100, 150, 200, 250])
-        self.thermal_conduct = round(random.uniform(0.30, 0.65), 2)
-        self.upper_temp_limit = round(random.uniform(56, 71), 2)
-        self.lower_temp_limit = self.upper_temp_limit - round(random.uniform(1, 5), 2)
-        self.current_temp = round(random.uniform(self.lower_temp_limit, self.upper_temp_limit), 2)
+    def randomise_settings(self, rng=None):
+        if rng is None:
+            self.element_rating = random.choice([2000, 3000, 4000])
+            self.mass = random.choice([100, 150, 200, 250])
+            self.thermal_conduct = round(random.uniform(0.30, 0.65), 2)
+            self.upper_temp_limit = round(random.uniform(56, 71), 2)
+            self.lower_temp_limit = self.upper_temp_limit - round(random.uniform(1, 5), 2)
+            self.current_temp = round(random.uniform(self.lower_temp_limit, self.upper_temp_limit), 2)
+        else:
+            self.element_rating = int(rng.choice([2000, 3000, 4000]))
+            self.mass = int(rng.choice([100, 150, 200, 250]))
+            self.thermal_conduct = round(float(rng.uniform(0.30, 0.65)), 2)
+            self.upper_temp_limit = round(float(rng.uniform(56, 71)), 2)
+            self.lower_temp_limit = self.upper_temp_limit - round(float(rng.uniform(1, 5)), 2)
+            self.current_temp = round(float(rng.uniform(self.lower_temp_limit, self.upper_temp_limit)), 2)
+    
+    def update_element(self, time_step):
+        """Apply the thermostat hysteresis for one time step and return the element power (W)."""
+        if self.is_active:
+            if self.element_on:
+                if self.current_temp < self.upper_temp_limit:
+                    self.current_temp = self.increase_temp(time_step)
+                    return self.element_rating
+                self.element_on = False
+            elif self.current_temp < self.lower_temp_limit:
+                self.element_on = True
+                self.current_temp = self.increase_temp(time_step)
+                return self.element_rating
+        return 0
     
     def standing_loss (self, ambient_temperature, time_step):
-        alpha = self.calculate_alpha(time_step)
-        return ambient_temperature + ((self.current_temp-ambient_temperature)*math.exp(alpha))
+        try:
+            decay = self._coefficients[time_step].decay
+        except (AttributeError, KeyError, TypeError):
+            decay = self.coefficients(time_step).decay
+        return ambient_temperature + ((self.current_temp-ambient_temperature)*decay)
+
+class CompactEWH:
+    """EWH stored in __slots__ instead of a per-instance __dict__.
+
+    Has the attributes and methods of EWH, so it can be used wherever an EWH
+    is, at a fraction of the memory per heater, but takes no other
+    attributes. from_ewh and to_ewh convert between the two.
+    """
+    attributes = ('activation_timer', 'always_on', 'current_temp', 'draw_event', 'draw_rate',
+                  'element_on', 'element_rating', 'full_draw_duration', 'inlet_temp', 'is_active',
+                  'lower_temp_limit', 'mass', 'randomised', 'thermal_conduct', 'upper_temp_limit',
+                  'volume')
+    # the coefficient parameters are properties stored in _<name> slots; the coefficient
+    # memo is not copied by from_ewh and to_ewh, it is rebuilt on first use
+    __slots__ = tuple('_' + name if name in ('element_rating', 'mass', 'thermal_conduct', 'volume')
+                      else name for name in attributes) + ('_coefficients',)
+
+    __init__ = EWH.__init__
+    calculate_alpha = EWH.calculate_alpha
+    calculate_power = EWH.calculate_power
+    element_rating = EWH.element_rating
+    mass = EWH.mass
+    thermal_conduct = EWH.thermal_conduct
+    volume = EWH.volume
+    coefficients = EWH.coefficients
+    draw_event_loss = EWH.draw_event_loss
+    initialise_temp = EWH.initialise_temp
+    increase_temp = EWH.increase_temp
+    randomise_settings = EWH.randomise_settings
+    update_element = EWH.update_element
+    standing_loss = EWH.standing_loss
+
+    @classmethod
+    def from_ewh(cls, ewh):
+        compact = cls.__new__(cls)
+        for name in cls.attributes:
+            setattr(compact, name, getattr(ewh, name))
+        return compact
+
+    def to_ewh(self):
+        ewh = EWH.__new__(EWH)
+        for name in self.attributes:
+            setattr(ewh, name, getattr(self, name))
+        return ewh
+
+# scalar heater classes accepted wherever a single heater is
+HEATER_TYPES = (EWH, CompactEWH)
 
 class Simulation:
     def __init__(self, activation_limit=150, ambient_temperature=25.2, days=5, 
@@ -123,11 +242,12 @@ class Simulation:
         return draw_periods
     
     def generate_bounded_draw_periods(self, start_hour=6, end_hour=8):
-        start_period = start_hour * self.time_scale
-        end_period = end_hour*self.time_scale
+        # hours as periods from absolute seconds, as time steps need not divide an hour
+        start_period = start_hour*3600//self.time_step
+        end_period = end_hour*3600//self.time_step
         
         bounded_periods = []
-        for i in range(0, self.day_periods, int(24*self.time_scale)):
+        for i in range(0, self.day_periods, 86400//self.time_step):
             event_bounds = range(start_period + i, end_period + i)
             bounded_periods.append(random.choice(event_bounds))
         
@@ -154,4 +274,391 @@ class Simulation:
     
     def generate_time_periods(self):
         return int((self.days*86400)/self.time_step)
-    
\ No newline at end of file
+    
+    def check_time_step(self):
+        # every day is simulated as a whole number of time steps
+        if 86400 % self.time_step:
+            raise ValueError("time_step must divide a day (86400 s), got {0}".format(self.time_step))
+    
+    def calendar(self, days, start_date=None, weather=None):
+        """Return the date of every simulation day as a numpy datetime64[D] array."""
+        import numpy as np
+        
+        if start_date is None:
+            start_date = weather.start if weather is not None and weather.start is not None else '2024-01-01'
+        return np.datetime64(start_date, 'D') + np.arange(days)
+    
+    def run(self, heaters, users, weather=None, days=None, shower=None, results=None, rng=None,
+            schedules=None, start_date=None, engine='step', checkpoint=None, checkpoint_every=1,
+            controller=None, instrumentation=None, draws=None, fine_step=5):
+        """Simulate the heaters against their users' shower draws.
+
+        heaters may be a single EWH or CompactEWH, a sequence of them, a
+        fleet.EWHFleet or a fleet.HEATER_DTYPE record array, whose states are
+        updated in place at the end of the run; users is a single User shared by every heater or one
+        User per heater. weather is a weather.WeatherSource or a sequence of
+        hourly ambient temperatures, which wraps around when exhausted; when
+        None the ambient temperature stays at self.ambient_temperature.
+        results is an optional results.ResultBuffer or writers.ChunkedWriter;
+        by default a ResultBuffer sized for the run is created. results must
+        be empty; a writer opened with resume=True is only for
+        Simulation.resume. rng is an optional numpy.random.Generator used for
+        shower sampling. When
+        schedules is a user.ScheduleCache every user gets a newly sampled
+        schedule each day, using the weekend pattern on Saturdays and Sundays
+        counted from start_date (default: the weather record start, else
+        2024-01-01). Otherwise each user's fixed schedule is reused. engine
+        'step' advances the fleet one vectorized step at a time, 'kernel'
+        runs each day through kernel.simulate (compiled when Numba is
+        installed) and 'adaptive' runs it with the adaptive loop, splitting
+        time steps into steps of fine_step seconds only around draws and
+        thermostat switches and recording the mean power of each step.
+        controller is an optional controllers.Controller applied
+        to the whole fleet every controller.interval steps. instrumentation
+        is an optional instrument.Instrumentation collecting per-phase
+        timings. draws is an optional population.DrawSchedule of merged
+        household draws, one tank per heater, used instead of sampling the
+        users' showers; users may then be None. When checkpoint is a file
+        path the full run state is saved there every checkpoint_every days;
+        see Simulation.resume.
+        Returns the results' dict of arrays with one row per recorded time
+        step and one column per heater.
+        """
+        import numpy as np
+        import fleet as ewh_fleet
+        import shower as ewh_shower
+        from results import ResultBuffer
+        from weather import WeatherSource
+        
+        if days is None:
+            days = self.days
+        if engine not in ('step', 'kernel', 'adaptive'):
+            raise ValueError("unknown engine '{0}'".format(engine))
+        self.check_time_step()
+        if isinstance(heaters, HEATER_TYPES):
+            heaters = [heaters]
+        records = None
+        if isinstance(heaters, ewh_fleet.EWHFleet):
+            ewhs = None
+            fleet = heaters
+        elif isinstance(heaters, np.ndarray) and heaters.dtype.names is not None:
+            ewhs = None
+            records = heaters
+            fleet = ewh_fleet.EWHFleet.from_records(records)
+        else:
+            ewhs = list(heaters)
+            fleet = ewh_fleet.EWHFleet.from_ewhs(ewhs)
+        if draws is not None:
+            if draws.tanks != len(fleet):
+                raise ValueError("expected draws for {0} tanks, got {1}".format(len(fleet), draws.tanks))
+        else:
+            if not isinstance(users, (list, tuple)):
+                users = [users] * len(fleet)
+            if len(users) != len(fleet):
+                raise ValueError("expected one user per heater, got {0} users for {1} heaters"
+                                 .format(len(users), len(fleet)))
+        if shower is None:
+            shower = ewh_shower.Shower()
+        
+        # set EWH temp control to run continuously
+        fleet.is_active = fleet.is_active | fleet.always_on
+        
+        sim_period = int(86400/self.time_step)
+        if weather is not None and not isinstance(weather, WeatherSource):
+            weather = WeatherSource(weather)
+        if results is not None and results.period:
+            raise ValueError("results already hold {0} periods, continue a run with Simulation.resume"
+                             .format(results.period))
+        if results is None:
+            # adaptive steps record fractional mean power
+            dtypes = {'power': np.float32} if engine == 'adaptive' else None
+            results = ResultBuffer(sim_period * days, len(fleet), days=days, dtypes=dtypes)
+        if controller is not None:
+            controller.reset(fleet, self.time_step)
+        
+        run_state = {'fleet': fleet, 'ewhs': ewhs, 'records': records, 'users': users, 'weather': weather,
+                     'shower': shower, 'results': results, 'rng': rng, 'schedules': schedules,
+                     'engine': engine, 'fine_step': fine_step, 'days': days, 'sim_period': sim_period,
+                     'controller': controller, 'instrumentation': instrumentation,
+                     'dates': self.calendar(days, start_date, weather),
+                     'draws': draws,
+                     'table': None if draws is not None else ewh_shower.cdf_table(users),
+                     'checkpoint': checkpoint, 'checkpoint_every': checkpoint_every,
+                     # next day to simulate
+                     'day': 0,
+                     # draws running past midnight continue into the following day,
+                     # until carry_end minutes after midnight
+                     'carry_end': np.zeros(len(fleet), dtype=np.int64),
+                     'carry_intensity': np.zeros(len(fleet))}
+        return self._advance(run_state)
+    
+    def draw_rate(self, period, start, end, intensity, carry_end, carry_intensity):
+        """Return the draw rate (l/s) of every heater at time step(s) `period` of a day.
+
+        start and end bound the day's showers in seconds from midnight;
+        showers carried over from the previous day run until carry_end
+        seconds, unless a new shower is running. When the time step divides a
+        minute the (whole-minute) showers cover whole steps; otherwise steps
+        partly covered by a shower get its mean rate over the step, so the
+        drawn volume does not depend on the time step.
+        """
+        import numpy as np
+        
+        step_start = period*self.time_step
+        if 60 % self.time_step == 0:
+            return np.where((step_start >= start) & (step_start < end), intensity,
+                            np.where(step_start < carry_end, carry_intensity, 0.0))
+        step_end = step_start + self.time_step
+        overlap = np.clip(np.minimum(end, step_end) - np.maximum(start, step_start), 0, self.time_step)
+        carried = np.clip(np.minimum(carry_end, step_end) - step_start, 0, self.time_step)
+        return np.where(overlap > 0, intensity*overlap/self.time_step,
+                        carry_intensity*carried/self.time_step)
+    
+    def _advance(self, run_state):
+        """Simulate the remaining days of a run started by run or restored by resume."""
+        import numpy as np
+        if run_state['engine'] in ('kernel', 'adaptive'):
+            import kernel
+        
+        fleet = run_state['fleet']
+        users = run_state['users']
+        weather = run_state['weather']
+        shower = run_state['shower']
+        results = run_state['results']
+        rng = run_state['rng']
+        schedules = run_state['schedules']
+        sim_period = run_state['sim_period']
+        controller = run_state['controller']
+        draws = run_state.get('draws')
+        # fine steps of the adaptive engine
+        fine_step = run_state.get('fine_step') if run_state['engine'] == 'adaptive' else None
+        # phase timings are only taken when instrumentation is enabled
+        probe = run_state['instrumentation']
+        if probe is not None:
+            probe.start(len(fleet), self.time_step)
+        # coefficients shared by every tank of the same configuration
+        decay, heat_gain, _ = fleet.coefficients(self.time_step)
+        
+        while run_state['day'] < run_state['days']:
+            sim_day = run_state['day']
+            carry_end = run_state['carry_end']
+            carry_intensity = run_state['carry_intensity']
+            if probe is not None:
+                mark = probe.clock()
+            if draws is not None:
+                # the step engine densifies the merged population draws (including draws running
+                # past midnight) an hour at a time, bounding memory at short time steps
+                chunk = max(3600//self.time_step, 1)
+                start_time = draws.first_starts(sim_day*86400, 86400)
+                results.record_day(sim_day, np.where(start_time >= 0, start_time//60, -1))
+                end_time = np.zeros(len(fleet), dtype=np.int64)
+                intensity = np.zeros(len(fleet))
+                if probe is not None:
+                    mark = probe.add('showers', mark)
+            else:
+                if schedules is not None:
+                    weekday = bool(np.is_busday(run_state['dates'][sim_day]))
+                    run_state['table'] = schedules.daily_table(users, weekday=weekday, rng=rng)
+                    if probe is not None:
+                        mark = probe.add('schedules', mark)
+                # run shower usage simulation
+                start_time, end_time, intensity = (event[0] for event in
+                                                   shower.simulate_batch(users, rng=rng, table=run_state['table']))
+                results.record_day(sim_day, start_time)
+                # shower minutes as seconds from midnight
+                bounds = (start_time*60, end_time*60, intensity, carry_end*60, carry_intensity)
+                if probe is not None:
+                    mark = probe.add('showers', mark)
+            # the day's ambient temps, updated every hour from measured data
+            if weather is not None:
+                ambient = weather.profile(sim_day*sim_period, sim_period, self.time_step)
+                if probe is not None:
+                    mark = probe.add('weather', mark)
+            
+            if run_state['engine'] != 'step':
+                if weather is None:
+                    ambient = np.full(sim_period, self.ambient_temperature)
+                # run the kernel between control decisions, which fall on absolute steps as in the
+                # step engine, so blocks started the previous day continue past midnight; long
+                # blocks are split so no (steps, tanks) array exceeds KERNEL_BLOCK_VALUES
+                interval = sim_period if controller is None else controller.interval
+                chunk = max(min(KERNEL_BLOCK_VALUES//len(fleet), sim_period), 1)
+                blocks = sorted({0, *range(-(sim_day*sim_period) % interval, sim_period, interval),
+                                 *range(0, sim_period, chunk)})
+                for block, end in zip(blocks, blocks[1:] + [sim_period]):
+                    if controller is not None and (sim_day*sim_period + block) % interval == 0:
+                        controller.apply(sim_day*sim_period + block, fleet)
+                        if probe is not None:
+                            mark = probe.add('control', mark)
+                    if draws is not None:
+                        draw_rate = draws.dense(sim_day*sim_period + block, end - block, self.time_step)
+                    else:
+                        draw_rate = self.draw_rate(np.arange(block, end)[:, None], *bounds)
+                    if probe is not None:
+                        mark = probe.add('draws', mark)
+                    temperature, power = kernel.simulate(fleet, ambient[block:end], draw_rate,
+                                                         self.time_step, fine_step=fine_step)
+                    if probe is not None:
+                        mark = probe.add('thermal', mark)
+                    results.record_block(temperature, power, draw_rate*60)
+                    if probe is not None:
+                        mark = probe.add('output', mark)
+                self.ambient_temperature = ambient[-1]
+            else:
+                for period in range(sim_period):
+                    if weather is not None:
+                        self.ambient_temperature = ambient[period]
+                    if controller is not None and (sim_day*sim_period + period) % controller.interval == 0:
+                        controller.apply(sim_day*sim_period + period, fleet)
+                        if probe is not None:
+                            mark = probe.add('control', mark)
+                    
+                    if draws is not None:
+                        if period % chunk == 0:
+                            day_rate = draws.dense(sim_day*sim_period + period, min(chunk, sim_period - period),
+                                                   self.time_step)
+                        draw_rate = day_rate[period % chunk]
+                    else:
+                        draw_rate = self.draw_rate(period, *bounds)
+                    if probe is not None:
+                        mark = probe.add('draws', mark)
+                    
+                    power = fleet.step(self.ambient_temperature, draw_rate, self.time_step, decay=decay,
+                                       heat_gain=heat_gain)
+                    if probe is not None:
+                        mark = probe.add('thermal', mark)
+                    results.record(fleet.current_temp, power, draw_rate*60)
+                    if probe is not None:
+                        mark = probe.add('output', mark)
+            
+            run_state['carry_end'] = np.maximum(end_time - 1440, 0)
+            run_state['carry_intensity'] = intensity
+            run_state['day'] += 1
+            if probe is not None:
+                probe.day(run_state['day'], run_state['days'], sim_period)
+            if (run_state['checkpoint'] is not None and run_state['day'] < run_state['days']
+                    and run_state['day'] % run_state['checkpoint_every'] == 0):
+                if probe is not None:
+                    mark = probe.clock()
+                self.save_checkpoint(run_state)
+                if probe is not None:
+                    probe.add('checkpoint', mark)
+        
+        results.flush()
+        if probe is not None:
+            probe.stop()
+        if run_state['ewhs'] is not None:
+            states = [getattr(fleet, name).tolist() for name in fleet.states]
+            for ewh, values in zip(run_state['ewhs'], zip(*states)):
+                for name, value in zip(fleet.states, values):
+                    setattr(ewh, name, value)
+        if run_state.get('records') is not None:
+            for name in fleet.states:
+                run_state['records'][name] = getattr(fleet, name)
+        
+        return results.data
+    
+    def save_checkpoint(self, run_state):
+        """Atomically write the simulation, run state and random states to run_state['checkpoint']."""
+        import os
+        import pickle
+        import numpy as np
+        
+        # make the output on disk consistent with the saved offsets
+        run_state['results'].sync()
+        checkpoint = {'simulation': self, 'run_state': run_state,
+                      'random_state': random.getstate(), 'np_random_state': np.random.get_state()}
+        path = run_state['checkpoint']
+        with open(path + '.tmp', 'wb') as checkpoint_file:
+            pickle.dump(checkpoint, checkpoint_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path + '.tmp', path)
+    
+    @staticmethod
+    def resume(path):
+        """Continue a run from the checkpoint file at path.
+
+        The simulation, heaters, users, weather position, generator and
+        global random states and output offsets are restored, output written
+        after the checkpoint is discarded, and the remaining days are run
+        exactly as the original run would have. Returns the results of run.
+        """
+        import pickle
+        import numpy as np
+        
+        with open(path, 'rb') as checkpoint_file:
+            checkpoint = pickle.load(checkpoint_file)
+        random.setstate(checkpoint['random_state'])
+        np.random.set_state(checkpoint['np_random_state'])
+        run_state = checkpoint['run_state']
+        run_state['checkpoint'] = path
+        run_state['results'].rewind()
+        return checkpoint['simulation']._advance(run_state)
+    
+    def run_events(self, heaters, users, weather=None, days=None, shower=None, trace=False,
+                   rng=None, schedules=None, start_date=None):
+        """Simulate the heaters with event-driven stepping (see event_driven).
+
+        Takes the same heaters, users, weather, shower, rng, schedules and
+        start_date arguments as run but
+        jumps analytically between draw, ambient and thermostat events instead
+        of evaluating every time step. Returns a dict with the element
+        'energy' (J) and shower 'start_times' of every heater, plus per-step
+        'temperature', 'power' and 'draw' arrays when trace is True.
+        """
+        import numpy as np
+        import event_driven
+        from weather import WeatherSource
+        
+        if days is None:
+            days = self.days
+        self.check_time_step()
+        if isinstance(heaters, HEATER_TYPES):
+            heaters = [heaters]
+        heaters = list(heaters)
+        if not isinstance(users, (list, tuple)):
+            users = [users] * len(heaters)
+        if len(users) != len(heaters):
+            raise ValueError("expected one user per heater, got {0} users for {1} heaters"
+                             .format(len(users), len(heaters)))
+        import shower as ewh_shower
+        if shower is None:
+            shower = ewh_shower.Shower()
+        table = ewh_shower.cdf_table(users)
+        if weather is not None and not isinstance(weather, WeatherSource):
+            weather = WeatherSource(weather)
+        dates = self.calendar(days, start_date, weather)
+        
+        sim_period = int(86400/self.time_step)
+        sim_duration = sim_period * days
+        # sample showers in the same day-by-day order as run
+        events = []
+        for sim_day in range(days):
+            if schedules is not None:
+                table = schedules.daily_table(users, weekday=bool(np.is_busday(dates[sim_day])), rng=rng)
+            events.append(shower.simulate_batch(users, rng=rng, table=table))
+        start_time, end_time, intensity = (np.concatenate(event) for event in zip(*events))
+        
+        results = {'energy': np.zeros(len(heaters)),
+                   'start_times': start_time.astype(np.int16)}
+        if trace:
+            for name in ('temperature', 'power', 'draw'):
+                results[name] = np.empty((sim_duration, len(heaters)))
+        
+        for i, ewh in enumerate(heaters):
+            if ewh.always_on:
+                ewh.is_active = True
+            # shower minutes as step ranges
+            draws = [draw for sim_day in range(days)
+                     for draw in event_driven.step_draws(int(start_time[sim_day, i]), int(end_time[sim_day, i]),
+                                                         float(intensity[sim_day, i]), self.time_step,
+                                                         offset=sim_day*sim_period)]
+            energy, ewh_trace = event_driven.simulate(ewh, draws, sim_duration, self.time_step,
+                                                      weather=None if weather is None else weather.temperatures,
+                                                      ambient_temperature=self.ambient_temperature,
+                                                      trace=trace)
+            results['energy'][i] = energy
+            if trace:
+                for name, values in zip(('temperature', 'power', 'draw'), ewh_trace):
+                    results[name][:, i] = values
+        
+        return results
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""
+Array-based EWH fleet model.
+
+Every heater parameter is held as a NumPy column with one entry per tank so a
+single call to EWHFleet.step updates the whole fleet at once. The update
+reproduces the scalar ewh_sim.EWH methods and the element hysteresis logic of
+the original simulation loop tank-for-tank.
+
+A fleet converts to and from a list of ewh_sim.EWH (or CompactEWH) objects and
+a structured record array of dtype HEATER_DTYPE, one row per heater, which
+stores a heater in a fixed number of bytes and can be saved with np.save.
+"""
+import numpy as np
+import coefficients
+import ewh_sim
+from ewh_sim import specific_heat_cap
+
+class EWHFleet:
+    # per-tank parameter and state columns, in the order used by from_ewhs/to_ewhs
+    parameters = ('element_rating', 'draw_rate', 'inlet_temp', 'mass',
+                  'thermal_conduct', 'upper_temp_limit', 'lower_temp_limit', 'volume')
+    states = ('current_temp', 'always_on', 'is_active', 'element_on', 'draw_event')
+
+    def __init__(self, size=1, always_on=False, element_rating=3000, draw_rate=15,
+                 inlet_temp=25, mass=150, thermal_conduct=0.341,
+                 upper_temp_limit=60, lower_temp_limit=50, volume=150):
+        self.size = int(size)
+        self.always_on = self._column(always_on, bool)
+        self.current_temp = self._column(25.2)
+        self.draw_event = self._column(False, bool)
+        # draw rate is stored in l/s, matching EWH.draw_rate
+        self.draw_rate = self._column(draw_rate)/60
+        self.element_on = self._column(False, bool)
+        self.element_rating = self._column(element_rating)
+        self.inlet_temp = self._column(inlet_temp)
+        self.is_active = self.always_on.copy()
+        self.lower_temp_limit = self._column(lower_temp_limit)
+        self.mass = self._column(mass)
+        self.thermal_conduct = self._column(thermal_conduct)
+        self.upper_temp_limit = self._column(upper_temp_limit)
+        self.volume = self._column(volume)
+        # time step -> (key, Coefficients) of the last coefficients() call with that step
+        self._coefficients = {}
+
+    def __len__(self):
+        return self.size
+
+    def _column(self, value, dtype=np.float64):
+        column = np.empty(self.size, dtype=dtype)
+        column[:] = value
+        return column
+
+    @classmethod
+    def from_ewhs(cls, ewhs):
+        """Build a fleet from a sequence of scalar EWH objects."""
+        ewhs = list(ewhs)
+        fleet = cls(size=len(ewhs))
+        for name in cls.parameters + cls.states:
+            setattr(fleet, name, np.array([getattr(ewh, name) for ewh in ewhs],
+                                          dtype=getattr(fleet, name).dtype))
+        return fleet
+
+    def to_ewhs(self, cls=None):
+        """Return the fleet as a list of scalar EWH objects with the same state.
+
+        cls is the heater class, ewh_sim.EWH by default or ewh_sim.CompactEWH.
+        """
+        if cls is None:
+            cls = ewh_sim.EWH
+        ewhs = []
+        for i in range(self.size):
+            ewh = cls(volume=self.volume[i].item())
+            for name in self.parameters + self.states:
+                setattr(ewh, name, getattr(self, name)[i].item())
+            ewh.full_draw_duration = (ewh.volume/(ewh.draw_rate*60)) * 60
+            ewhs.append(ewh)
+        return ewhs
+
+    @classmethod
+    def from_records(cls, records):
+        """Build a fleet from a HEATER_DTYPE record array.
+
+        The columns are contiguous copies of the record fields, as the
+        vectorized updates are much faster on contiguous columns than on
+        strided views.
+        """
+        fleet = cls(size=len(records))
+        for name in cls.parameters + cls.states:
+            setattr(fleet, name, np.array(records[name], dtype=getattr(fleet, name).dtype))
+        return fleet
+
+    def to_records(self, out=None):
+        """Return the parameters and states as a HEATER_DTYPE record array, written to out if given."""
+        if out is None:
+            out = np.empty(self.size, dtype=HEATER_DTYPE)
+        for name in self.parameters + self.states:
+            out[name] = getattr(self, name)
+        return out
+
+    def calculate_alpha(self, time_step):
+        return (-1*time_step)/(specific_heat_cap*self.mass*self.thermal_conduct)
+
+    def coefficients(self, time_step, intensity=0.0):
+        """Return per-tank (decay, heat_gain, sigma) arrays from the shared coefficients table.
+
+        intensity may be a scalar or a per-tank array of draw rates (l/s).
+        Each distinct configuration in the fleet is looked up once, and the
+        arrays of every time step are reused while the parameters and
+        intensity are unchanged.
+        """
+        columns = np.column_stack([self.mass, self.thermal_conduct, self.element_rating,
+                                   self.volume, np.broadcast_to(intensity, (self.size,))])
+        key = columns.tobytes()
+        cached = self._coefficients.get(time_step)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        # group identical rows: sort them and start a new group wherever a row changes
+        order = np.lexsort(columns.T[::-1])
+        ordered = columns[order]
+        first = np.ones(self.size, dtype=bool)
+        first[1:] = (ordered[1:] != ordered[:-1]).any(axis=1)
+        group = np.empty(self.size, dtype=np.int64)
+        group[order] = np.cumsum(first) - 1
+        values = np.array([coefficients.lookup(*configuration[:4], time_step, configuration[4])
+                           for configuration in ordered[first].tolist()]).reshape(-1, 3)[group]
+        result = coefficients.Coefficients(values[:, 0], values[:, 1], values[:, 2])
+        self._coefficients[time_step] = (key, result)
+        return result
+
+    def calculate_decay(self, time_step):
+        # the table applies math.exp per configuration, bit-identical to EWH.standing_loss
+        return self.coefficients(time_step).decay
+
+    def calculate_power(self, delta_temp, time_step):
+        return ((self.mass * specific_heat_cap * delta_temp)/time_step)
+
+    def draw_event_loss(self, draw_rate=None, *, time_step):
+        if draw_rate is None:
+            draw_rate = self.draw_rate
+        sigma = (self.volume - (draw_rate*time_step))/self.volume
+        return sigma * (self.current_temp - self.inlet_temp) + self.inlet_temp
+
+    def increase_temp(self, time_step):
+        energy = self.element_rating * time_step
+        return (energy)/(specific_heat_cap*self.mass) + self.current_temp
+
+    def initialise_temp(self, rng=None):
+        rng = np.random if rng is None else rng
+        self.element_on = rng.random(self.size) < 0.04
+        self.current_temp = np.round(rng.uniform(self.lower_temp_limit, self.upper_temp_limit), 2)
+
+    def randomise_settings(self, rng=None):
+        rng = np.random if rng is None else rng
+        self.element_rating = rng.choice([2000., 3000., 4000.], size=self.size)
+        self.mass = rng.choice([100., 150., 200., 250.], size=self.size)
+        self.thermal_conduct = np.round(rng.uniform(0.30, 0.65, self.size), 2)
+        self.upper_temp_limit = np.round(rng.uniform(56, 71, self.size), 2)
+        self.lower_temp_limit = self.upper_temp_limit - np.round(rng.uniform(1, 5, self.size), 2)
+        self.current_temp = np.round(rng.uniform(self.lower_temp_limit, self.upper_temp_limit), 2)
+
+    def standing_loss(self, ambient_temperature, time_step, decay=None):
+        if decay is None:
+            decay = self.calculate_decay(time_step)
+        return ambient_temperature + ((self.current_temp-ambient_temperature)*decay)
+
+    def update_element(self, time_step, heat_gain=None):
+        """Apply the thermostat hysteresis to every tank and return element power (W)."""
+        if heat_gain is None:
+            heat_gain = (self.element_rating * time_step)/(specific_heat_cap*self.mass)
+        # an active element keeps heating until the upper limit, an idle one
+        # switches on once the tank falls below the lower limit
+        limit = np.where(self.element_on, self.upper_temp_limit, self.lower_temp_limit)
+        heating = self.is_active & (self.current_temp < limit)
+        self.element_on = np.where(self.is_active, heating, self.element_on)
+        self.current_temp = np.where(heating, heat_gain + self.current_temp, self.current_temp)
+        return np.where(heating, self.element_rating, 0.0)
+
+    def step(self, ambient_temperature, draw_rate, time_step, decay=None, heat_gain=None):
+        """Advance every tank by one time step.
+
+        draw_rate is the per-tank draw in l/s (zero for tanks without a draw
+        event), drawn for the whole time step. Returns the element power (W)
+        of every tank.
+        """
+        # determine temperature change due to standing losses
+        self.current_temp = self.standing_loss(ambient_temperature, time_step, decay)
+        # perform draw events
+        draw_rate = np.asarray(draw_rate, dtype=np.float64)
+        self.draw_event = draw_rate > 0
+        self.current_temp = np.where(self.draw_event, self.draw_event_loss(draw_rate, time_step=time_step),
+                                     self.current_temp)
+        # determine temperature change due to ewh element
+        return self.update_element(time_step, heat_gain)
+
+# one heater per record: float64 parameters and temperature, boolean flags
+HEATER_DTYPE = np.dtype([(name, np.float64) for name in EWHFleet.parameters + ('current_temp',)]
+                        + [(name, np.bool_) for name in EWHFleet.states[1:]])
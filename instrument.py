@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+Run-time instrumentation for Simulation.run.
+
+An Instrumentation passed to Simulation.run accumulates wall time and call
+counts for each phase of the simulation loop (schedule and shower sampling,
+weather lookups, draw assembly, control, thermal updates, output and
+checkpoints) and reports overall steps/s and tank-minutes/s. It can log
+progress every `progress` seconds and record a cProfile dump of the run. When
+no instrumentation is given the loop only tests for None once per phase.
+"""
+import time
+
+class Instrumentation:
+    phases = ('schedules', 'showers', 'weather', 'draws', 'control', 'thermal', 'output',
+              'checkpoint')
+
+    def __init__(self, progress=None, profile=None, log=print):
+        """progress is the interval in seconds between progress messages
+        passed to log, profile a file path for a cProfile dump of the run."""
+        self.progress = progress
+        self.profile = profile
+        self.log = log
+        self.seconds = dict.fromkeys(self.phases, 0.0)
+        self.calls = dict.fromkeys(self.phases, 0)
+        self.wall = 0.0
+        self.steps = 0
+        self.tanks = 0
+        self.time_step = None
+        self.profiler = None
+        self._started = None
+        self._reported = None
+
+    clock = staticmethod(time.perf_counter)
+
+    def add(self, phase, start):
+        """Charge the time since start to phase and return the current clock."""
+        now = time.perf_counter()
+        self.seconds[phase] += now - start
+        self.calls[phase] += 1
+        return now
+
+    def start(self, tanks, time_step):
+        self.tanks = tanks
+        self.time_step = time_step
+        self._started = self._reported = time.perf_counter()
+        if self.profile is not None:
+            import cProfile
+
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    def stop(self):
+        self.wall += time.perf_counter() - self._started
+        self._started = None
+        if self.profiler is not None:
+            self.profiler.disable()
+            self.profiler.dump_stats(self.profile)
+            self.profiler = None
+
+    def day(self, day, days, steps):
+        """Count a completed day of `steps` time steps and log progress when due."""
+        self.steps += steps
+        if self.progress is None:
+            return
+        now = time.perf_counter()
+        if now - self._reported >= self.progress or day == days:
+            self._reported = now
+            elapsed = self.wall + now - self._started
+            self.log("day {0}/{1}: {2:.0f} steps/s, {3:.0f} tank-minutes/s".format(
+                day, days, self.steps/elapsed, self.tank_minutes()/elapsed))
+
+    def tank_minutes(self):
+        return self.steps*self.tanks*self.time_step/60
+
+    def report(self):
+        """Return the wall time, throughput and per-phase seconds and calls as a dict."""
+        wall = self.wall if self._started is None else self.wall + time.perf_counter() - self._started
+        return {'wall': wall, 'steps': self.steps, 'tanks': self.tanks,
+                'steps_per_second': self.steps/wall if wall else None,
+                'tank_minutes_per_second': self.tank_minutes()/wall if wall else None,
+                'phases': {phase: {'seconds': self.seconds[phase], 'calls': self.calls[phase]}
+                           for phase in self.phases}}
+
+    def summary(self):
+        """Return the report as a readable table."""
+        report = self.report()
+        lines = ["{0} steps of {1} tanks in {2:.3f} s: {3:.0f} steps/s, {4:.0f} tank-minutes/s".format(
+            report['steps'], report['tanks'], report['wall'], report['steps_per_second'] or 0,
+            report['tank_minutes_per_second'] or 0)]
+        for phase, values in report['phases'].items():
+            share = values['seconds']/report['wall']*100 if report['wall'] else 0
+            lines.append("  {0:<12} {1:>10.3f} s {2:>6.1f} % {3:>10} calls".format(
+                phase, values['seconds'], share, values['calls']))
+        return '\n'.join(lines)
+
+    def __getstate__(self):
+        # checkpoints keep the counters and elapsed time but not the live profiler
+        state = self.__dict__.copy()
+        state['profiler'] = None
+        if self._started is not None:
+            state['wall'] = self.wall + time.perf_counter() - self._started
+            state['_started'] = None
+        return state
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+"""
+Compiled per-tank time loop.
+
+The thermostat logic is sequential in time, so the whole horizon of a fleet is
+run by a single loop over time steps and tanks. When Numba is installed the
+loop is JIT-compiled (Numba is imported on first use, so importing this
+module stays cheap); otherwise simulate falls back to stepping scalar
+ewh_sim.EWH objects with their standing_loss, draw_event_loss,
+increase_temp and update_element methods. Both paths give identical results,
+which test_kernel.py verifies against the original EWH stepping of main.py.
+
+With a fine_step, simulate runs the adaptive loop instead. Each time step is
+split into fine steps where a tank has a draw or its thermostat switches, and
+is advanced in closed form otherwise (see _adaptive_loop).
+"""
+import numpy as np
+import ewh_sim
+
+def _tank_loop(current_temp, element_on, is_active, decay, heat_gain, upper_temp_limit,
+               lower_temp_limit, volume, inlet_temp, element_rating, ambient, draw_rate,
+               time_step, temperature, power):
+    periods, tanks = draw_rate.shape
+    for t in range(periods):
+        for i in range(tanks):
+            # standing loss, same operation order as EWH.standing_loss
+            temp = ambient[t] + ((current_temp[i] - ambient[t])*decay[i])
+            # draw loss, as EWH.draw_event_loss drawing for the whole time step
+            if draw_rate[t, i] > 0:
+                sigma = (volume[i] - (draw_rate[t, i]*time_step))/volume[i]
+                temp = sigma * (temp - inlet_temp[i]) + inlet_temp[i]
+            # element hysteresis, as EWH.update_element
+            heating = False
+            if is_active[i]:
+                if element_on[i]:
+                    heating = temp < upper_temp_limit[i]
+                else:
+                    heating = temp < lower_temp_limit[i]
+                element_on[i] = heating
+            if heating:
+                temp = heat_gain[i] + temp
+                power[t, i] = element_rating[i]
+            else:
+                power[t, i] = 0.0
+            current_temp[i] = temp
+            temperature[t, i] = temp
+
+def _adaptive_loop(current_temp, element_on, is_active, decay, heat_gain, jump_decay,
+                   upper_temp_limit, lower_temp_limit, volume, inlet_temp, element_rating,
+                   ambient, draw_rate, fine_step, substeps, temperature, power):
+    """_tank_loop over time steps made of `substeps` fine steps.
+
+    decay and heat_gain are per fine step and jump_decay is
+    decay**(substeps - 1). Within a step without a draw the element mode is
+    fixed until the thermostat switches, so the fine-step temperatures are
+    T_k = fixed + (T_0 - fixed)*decay**k and their loss values are monotonic:
+    checking the first and last fine step tells whether the thermostat
+    switches. Steps where it does not are advanced in one jump, the others
+    (and all steps with a draw) fine step by fine step. power receives the
+    mean element power over each step.
+    """
+    periods, tanks = draw_rate.shape
+    for t in range(periods):
+        for i in range(tanks):
+            temp = current_temp[i]
+            if draw_rate[t, i] <= 0:
+                heating = is_active[i] and element_on[i]
+                gain = heat_gain[i] if heating else 0.0
+                fixed = ambient[t] + gain/(1 - decay[i])
+                # loss values of the first and last fine step in the current mode
+                first = ambient[t] + ((temp - ambient[t])*decay[i])
+                before_last = fixed + (temp - fixed)*jump_decay[i]
+                last = ambient[t] + ((before_last - ambient[t])*decay[i])
+                if not is_active[i]:
+                    switch = False
+                elif heating:
+                    switch = max(first, last) >= upper_temp_limit[i]
+                else:
+                    switch = min(first, last) < lower_temp_limit[i]
+                if not switch:
+                    current_temp[i] = last + gain
+                    temperature[t, i] = current_temp[i]
+                    power[t, i] = element_rating[i] if heating else 0.0
+                    continue
+            # fine steps, as _tank_loop
+            energy = 0.0
+            sigma = (volume[i] - (draw_rate[t, i]*fine_step))/volume[i]
+            for _ in range(substeps):
+                temp = ambient[t] + ((temp - ambient[t])*decay[i])
+                if draw_rate[t, i] > 0:
+                    temp = sigma * (temp - inlet_temp[i]) + inlet_temp[i]
+                heating = False
+                if is_active[i]:
+                    if element_on[i]:
+                        heating = temp < upper_temp_limit[i]
+                    else:
+                        heating = temp < lower_temp_limit[i]
+                    element_on[i] = heating
+                if heating:
+                    temp = heat_gain[i] + temp
+                    energy += element_rating[i]
+            current_temp[i] = temp
+            temperature[t, i] = temp
+            power[t, i] = energy/substeps
+
+# loop -> JIT-compiled loop, None when Numba is not installed
+_compiled_loops = {}
+
+def compile_loop(loop):
+    """Return the JIT-compiled loop, compiling it on first use, or None without Numba."""
+    if loop not in _compiled_loops:
+        try:
+            import numba
+        except ImportError:
+            _compiled_loops[loop] = None
+        else:
+            _compiled_loops[loop] = numba.njit(cache=True, nogil=True)(loop)
+    return _compiled_loops[loop]
+
+def compiled_loop():
+    """Return the JIT-compiled _tank_loop, or None when Numba is not installed."""
+    return compile_loop(_tank_loop)
+
+def available():
+    return compiled_loop() is not None
+
+def _ewh_loop(fleet, ambient, draw_rate, time_step, temperature, power):
+    """Fallback stepping every tank with the scalar EWH methods."""
+    ewhs = fleet.to_ewhs(cls=ewh_sim.CompactEWH)
+    for i, ewh in enumerate(ewhs):
+        for t in range(len(ambient)):
+            ewh.current_temp = ewh.standing_loss(ambient[t], time_step)
+            if draw_rate[t, i] > 0:
+                ewh.current_temp = ewh.draw_event_loss(draw_rate=draw_rate[t, i], time_step=time_step)
+            power[t, i] = ewh.update_element(time_step)
+            temperature[t, i] = ewh.current_temp
+    fleet.current_temp = np.array([ewh.current_temp for ewh in ewhs])
+    fleet.element_on = np.array([ewh.element_on for ewh in ewhs], dtype=bool)
+
+def _fleet_loop(fleet, ambient, draw_rate, time_step, temperature, power):
+    """Step fleets with their own node model (e.g. stratified.StratifiedFleet) one step at a time."""
+    decay, heat_gain, _ = fleet.coefficients(time_step)
+    for t in range(len(ambient)):
+        power[t] = fleet.step(ambient[t], draw_rate[t], time_step, decay=decay, heat_gain=heat_gain)
+        temperature[t] = fleet.current_temp
+
+def simulate(fleet, ambient, draw_rate, time_step, jit=None, temperature=None, power=None,
+             fine_step=None):
+    """Run a fleet.EWHFleet over a horizon in one call.
+
+    ambient holds the ambient temperature of every step and draw_rate the
+    (steps, tanks) draw in l/s. The fleet state is updated in place. jit=None
+    uses the compiled loop when Numba is available, jit=False forces the EWH
+    fallback. Multi-node fleets are always advanced with their own step
+    method. With fine_step (seconds, dividing time_step) single-node fleets
+    use the adaptive loop, uncompiled when jit is False, and power is the
+    mean over each step. Returns (temperature, power) arrays of shape
+    (steps, tanks), written into the given arrays when provided.
+    """
+    ambient = np.ascontiguousarray(ambient, dtype=np.float64)
+    draw_rate = np.ascontiguousarray(draw_rate, dtype=np.float64).reshape(len(ambient), len(fleet))
+    if temperature is None:
+        temperature = np.empty(draw_rate.shape)
+    if power is None:
+        power = np.empty(draw_rate.shape)
+    if jit is None:
+        jit = available()
+    elif jit and not available():
+        raise ImportError("the compiled kernel requires numba")
+
+    if getattr(fleet, 'nodes', 1) > 1:
+        if fine_step is not None:
+            raise ValueError("adaptive stepping is only supported for single-node fleets")
+        _fleet_loop(fleet, ambient, draw_rate, time_step, temperature, power)
+        return temperature, power
+    if fine_step is not None:
+        substeps = int(round(time_step/fine_step))
+        if substeps < 1 or substeps*fine_step != time_step:
+            raise ValueError("fine_step must divide time_step, got {0} and {1}".format(fine_step, time_step))
+        current_temp = np.array(fleet.current_temp, dtype=np.float64)
+        element_on = np.array(fleet.element_on, dtype=np.bool_)
+        decay, heat_gain, _ = fleet.coefficients(fine_step)
+        loop = compile_loop(_adaptive_loop) if jit else _adaptive_loop
+        loop(current_temp, element_on, np.asarray(fleet.is_active, dtype=np.bool_), decay, heat_gain,
+             decay**(substeps - 1), fleet.upper_temp_limit, fleet.lower_temp_limit, fleet.volume,
+             fleet.inlet_temp, fleet.element_rating, ambient, draw_rate, fine_step, substeps,
+             temperature, power)
+        fleet.current_temp = current_temp
+        fleet.element_on = element_on
+    elif jit:
+        current_temp = np.array(fleet.current_temp, dtype=np.float64)
+        element_on = np.array(fleet.element_on, dtype=np.bool_)
+        decay, heat_gain, _ = fleet.coefficients(time_step)
+        compiled_loop()(current_temp, element_on, np.asarray(fleet.is_active, dtype=np.bool_),
+                         decay, heat_gain, fleet.upper_temp_limit,
+                         fleet.lower_temp_limit, fleet.volume, fleet.inlet_temp,
+                         fleet.element_rating, ambient, draw_rate, time_step, temperature, power)
+        fleet.current_temp = current_temp
+        fleet.element_on = element_on
+    else:
+        _ewh_loop(fleet, ambient, draw_rate, time_step, temperature, power)
+    fleet.draw_event = draw_rate[-1] > 0 if len(draw_rate) else fleet.draw_event
+    return temperature, power
+
+def parity_check(tanks=50, periods=2880, time_step=60, seed=0):
+    """Compare the compiled loop against the EWH fallback on random inputs.
+
+    Requires Numba, as without it both sides would run the fallback.
+    Returns the largest absolute temperature difference and the number of
+    differing power values; both are zero when the paths agree.
+    """
+    import fleet as ewh_fleet
+
+    rng = np.random.default_rng(seed)
+    reference = ewh_fleet.EWHFleet(tanks, always_on=True)
+    reference.randomise_settings(rng)
+    reference.initialise_temp(rng)
+    ambient = rng.uniform(0, 35, periods)
+    draw_rate = np.where(rng.random((periods, tanks)) < 0.02, 0.142, 0.0)
+
+    compiled = ewh_fleet.EWHFleet.from_ewhs(reference.to_ewhs())
+    temp_a, power_a = simulate(compiled, ambient, draw_rate, time_step, jit=True)
+    temp_b, power_b = simulate(reference, ambient, draw_rate, time_step, jit=False)
+    return float(np.abs(temp_a - temp_b).max()), int((power_a != power_b).sum())
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""
+Plotting and export helpers for simulation results.
+
+matplotlib and pandas are imported inside each function so headless runs of
+the simulation never pay their import cost.
+"""
+import numpy as np
+
+def results_to_dataframe(results, time_step, column=0, start='2024-01-01 00:00:00'):
+    """Return the results of a single heater as a date-time indexed DataFrame."""
+    import pandas as pd
+
+    # define date-time range
+    # date-time starts at midnight of the first day of the year
+    sim_datetime = pd.date_range(start, periods=len(results['temperature']),
+                                 freq="{0}s".format(time_step))
+    # initialise and populate dataframe index and columns
+    sim_df = pd.DataFrame(index=sim_datetime)
+    sim_df.index.name = 'datetime'
+    sim_df['EWH Temperature (C)'] = results['temperature'][:, column]
+    sim_df['EWH Power (kW)'] = results['power'][:, column]/1000
+    sim_df['Draw Volume (l/min)'] = results['draw'][:, column]
+    return sim_df
+
+def plot_simulation(sim_df, simulation_days, upper_temp_limit):
+    import matplotlib.pyplot as plt
+    from matplotlib.dates import DateFormatter
+
+    # figure display settings
+    date_format = DateFormatter("%H:%M")
+    plt.rcParams['figure.dpi'] = 300
+
+    # define plot figure
+    sim_fig, temp_ax = plt.subplots(1, figsize=(18, 7))
+
+    #plot simulation results
+    temp_ax.set_title("{0}-day EWH Simulation Results".format(simulation_days))
+    temp_ax.set_xlabel('Time')
+    temp_ax.set_ylabel('Temperature (C)')
+    temp_ax.margins(x=0.001, y=0.02)
+    temp_ax.xaxis.set_major_formatter(date_format)
+    temp_ax.plot(sim_df['EWH Temperature (C)'])
+    plt.ylim(0, upper_temp_limit+1)
+
+    power_ax = temp_ax.twinx()
+    power_ax.plot(sim_df['EWH Power (kW)'], color='tab:red')
+    power_ax.set_ylabel('Power (kW)')
+    power_ax.margins(x=0.002, y=0.02)
+    sim_fig.tight_layout()
+    return sim_fig
+
+def plot_pdf_hist(start_times, pdf):
+    import matplotlib.pyplot as plt
+
+    start_time_min = [round(x/60, 2) for x in start_times]
+    plt.hist(start_time_min, bins=np.arange(0, 24, 1), edgecolor="black", color="red")
+
+    # figure display settings
+    plt.rcParams['figure.dpi'] = 300
+
+    # define plot figure
+    cdf_fig, cdf_ax = plt.subplots(1, figsize=(18, 7))
+
+    #plot simulation results
+    cdf_ax.set_title('Water Usage PDF vs CDF')
+    cdf_ax.set_xlabel('Time')
+    cdf_ax.set_ylabel('Probability Water Usage (CDF)')
+    cdf_ax.margins(x=0.002, y=0.02)
+    cdf_ax.plot(np.cumsum(pdf))
+
+    pdf_ax = cdf_ax.twinx()
+    pdf_ax.plot(pdf, color='tab:red')
+    pdf_ax.set_ylabel('Probability Water Usage (PDF)')
+    pdf_ax.margins(x=0.002, y=0.02)
+    cdf_fig.tight_layout()
+    return cdf_fig
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic household populations and their merged hot water draws.
+
+generate samples a population of households, one tank per household: the
+household size, the age group of every occupant, and the shower subtype of the
+household by its penetration in shower.toml. It then samples the daily showers
+of every occupant (age-dependent frequency and duration, start times from the
+occupant's diurnal schedule, weekend schedules on Saturdays and Sundays) and
+merges each household's showers into one non-overlapping draw profile per
+tank, adding the flow rates where showers overlap.
+
+Household sizes and age mixes default to the module-level tables below and can
+be overridden per call. The diurnal statistics have no senior pattern, so
+seniors follow the home adult schedule.
+
+Populations are fully determined by their parameters, the integer seed and the
+statistics files, and with cache_dir set they are stored there as .npz files
+named after a hash of those inputs and reused by later calls.
+"""
+import hashlib
+import json
+import os
+import numpy as np
+import stats_registry
+from user import sample_minutes, sample_schedule_times
+
+AGES = ('child', 'teen', 'work_ad', 'home_ad', 'senior')
+# probability of each household size
+HOUSEHOLD_SIZES = {1: 0.29, 2: 0.34, 3: 0.15, 4: 0.15, 5: 0.07}
+# age mix of the first occupant of every household and of further occupants
+HOUSEHOLDER_AGES = {'work_ad': 0.6, 'home_ad': 0.15, 'senior': 0.25}
+OCCUPANT_AGES = {'child': 0.35, 'teen': 0.2, 'work_ad': 0.3, 'home_ad': 0.05, 'senior': 0.1}
+# diurnal pattern group of age groups without their own pattern
+DIURNAL_GROUPS = {'senior': 'home_ad'}
+
+def merge_intervals(tank, start, end, rate):
+    """Merge possibly overlapping draws into non-overlapping constant-rate segments per tank.
+
+    Every draw adds `rate` to its tank's flow over [start, end). The draws
+    become +rate/-rate events that are sorted by tank and time and summed, so
+    the running sum is the tank's flow between consecutive events. Returns
+    (tank, start, end, rate) arrays of the segments with non-zero flow,
+    ordered by tank and start.
+    """
+    tank = np.concatenate([tank, tank])
+    time = np.concatenate([start, end])
+    delta = np.concatenate([rate, -np.asarray(rate)])
+    order = np.lexsort((time, tank))
+    tank, time, delta = tank[order], time[order], delta[order]
+    # collapse events at the same tank and time
+    last = np.ones(len(time), dtype=bool)
+    last[:-1] = (tank[1:] != tank[:-1]) | (time[1:] != time[:-1])
+    flow = np.cumsum(delta)[last]
+    tank, time = tank[last], time[last]
+    # the flow of every tank returns to zero after its last event
+    flow[np.abs(flow) < 1e-12] = 0.0
+    segment = (flow[:-1] > 0) & (tank[1:] == tank[:-1])
+    return tank[:-1][segment], time[:-1][segment], time[1:][segment], flow[:-1][segment]
+
+class DrawSchedule:
+    """Non-overlapping draw segments of every tank, with times in seconds from the simulation start."""
+
+    def __init__(self, tanks, tank, start, end, rate):
+        self.tanks = int(tanks)
+        # segments ordered by start time for window lookups
+        order = np.argsort(start, kind='stable')
+        self.tank = np.asarray(tank, dtype=np.int64)[order]
+        self.start = np.asarray(start, dtype=np.int64)[order]
+        self.end = np.asarray(end, dtype=np.int64)[order]
+        self.rate = np.asarray(rate, dtype=np.float64)[order]
+        self.longest = int((self.end - self.start).max()) if len(self.start) else 0
+
+    def __len__(self):
+        return len(self.start)
+
+    def window(self, start, seconds):
+        """Return the indices of the segments overlapping [start, start + seconds)."""
+        first = np.searchsorted(self.start, start - self.longest, side='left')
+        last = np.searchsorted(self.start, start + seconds, side='left')
+        index = np.arange(first, last)
+        return index[self.end[index] > start]
+
+    def dense(self, start_period, periods, time_step):
+        """Return the mean draw rate (l/s) of every tank in each of `periods` time steps.
+
+        Segments partly covering a step contribute in proportion to their
+        overlap, so the drawn volume is preserved at any time step.
+        """
+        window_start = start_period*time_step
+        index = self.window(window_start, periods*time_step)
+        start = np.maximum(self.start[index], window_start) - window_start
+        end = np.minimum(self.end[index], window_start + periods*time_step) - window_start
+        first = start // time_step
+        count = (end - 1)//time_step - first + 1
+        # one entry per (segment, covered step)
+        segment = np.repeat(np.arange(len(index)), count)
+        step = first[segment] + np.arange(len(segment)) - np.repeat(np.cumsum(count) - count, count)
+        overlap = np.minimum(end[segment], (step + 1)*time_step) - np.maximum(start[segment], step*time_step)
+        weights = self.rate[index][segment]*overlap/time_step
+        flat = step*self.tanks + self.tank[index][segment]
+        return np.bincount(flat, weights=weights, minlength=periods*self.tanks).reshape(periods, self.tanks)
+
+    def first_starts(self, start, seconds):
+        """Return the first draw start (seconds from start) of every tank in a window, or -1."""
+        index = self.window(start, seconds)
+        index = index[self.start[index] >= start]
+        first = np.full(self.tanks, -1, dtype=np.int64)
+        # segments are ordered by start, so the first write per tank wins when reversed
+        first[self.tank[index][::-1]] = self.start[index][::-1] - start
+        return first
+
+class Population:
+    """Households (one tank each), their occupants and merged draws."""
+
+    arrays = ('household_size', 'subtype', 'intensity', 'occupant_household', 'occupant_age',
+              'tank', 'start', 'end', 'rate')
+
+    def __init__(self, household_size, subtype, intensity, occupant_household, occupant_age,
+                 subtypes, draws, days):
+        self.household_size = household_size
+        # index into subtypes, -1 for households without a shower
+        self.subtype = subtype
+        self.intensity = intensity
+        self.occupant_household = occupant_household
+        # index into AGES
+        self.occupant_age = occupant_age
+        self.subtypes = list(subtypes)
+        self.draws = draws
+        self.days = days
+
+    def __len__(self):
+        return len(self.household_size)
+
+    def save(self, path):
+        values = dict(household_size=self.household_size, subtype=self.subtype,
+                      intensity=self.intensity, occupant_household=self.occupant_household,
+                      occupant_age=self.occupant_age, tank=self.draws.tank, start=self.draws.start,
+                      end=self.draws.end, rate=self.draws.rate)
+        with open(path + '.tmp', 'wb') as population_file:
+            np.savez(population_file, subtypes=np.array(self.subtypes), days=self.days, **values)
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as stored:
+            values = {name: stored[name] for name in cls.arrays}
+            draws = DrawSchedule(len(values['household_size']), values.pop('tank'), values.pop('start'),
+                                 values.pop('end'), values.pop('rate'))
+            return cls(subtypes=stored['subtypes'].tolist(), draws=draws, days=int(stored['days']),
+                       **values)
+
+def choose(options, size, rng):
+    """Sample `size` keys of an {option: probability} dict, returned as indices into its keys."""
+    p = np.array(list(options.values()), dtype=np.float64)
+    return rng.choice(len(p), size=size, p=p/p.sum())
+
+def cache_key(parameters):
+    """Hash the generation parameters together with the contents of the statistics files."""
+    digest = hashlib.sha256(json.dumps(parameters, sort_keys=True).encode())
+    for path in (stats_registry.DIURNAL_PATH, stats_registry.SHOWER_PATH):
+        with open(path, 'rb') as stats_file:
+            digest.update(stats_file.read())
+    return digest.hexdigest()[:24]
+
+def generate(households, days=1, seed=0, start_date='2024-01-01', cache_dir=None,
+             household_sizes=None, householder_ages=None, occupant_ages=None):
+    """Sample a population of `households` tanks and `days` days of merged shower draws.
+
+    seed is an integer seed for numpy.random.default_rng. Every showering
+    occupant gets a newly sampled schedule each day, using the weekend
+    pattern on days from start_date falling on Saturdays and Sundays. With
+    cache_dir the result is stored on and reused from disk. Returns a
+    Population.
+    """
+    household_sizes = HOUSEHOLD_SIZES if household_sizes is None else household_sizes
+    householder_ages = HOUSEHOLDER_AGES if householder_ages is None else householder_ages
+    occupant_ages = OCCUPANT_AGES if occupant_ages is None else occupant_ages
+    parameters = dict(households=int(households), days=int(days), seed=int(seed),
+                      start_date=str(start_date),
+                      household_sizes={str(key): value for key, value in household_sizes.items()},
+                      householder_ages=householder_ages, occupant_ages=occupant_ages)
+    if cache_dir is not None:
+        path = os.path.join(cache_dir, 'population-{0}.npz'.format(cache_key(parameters)))
+        if os.path.exists(path):
+            return Population.load(path)
+
+    rng = np.random.default_rng(int(seed))
+    usage_stats = stats_registry.load_toml(stats_registry.SHOWER_PATH)
+    durations = stats_registry.shower_durations()
+
+    # households and their occupants
+    sizes = np.array(list(household_sizes), dtype=np.int64)[choose(household_sizes, households, rng)]
+    occupant_household = np.repeat(np.arange(households), sizes)
+    first = np.zeros(len(occupant_household), dtype=bool)
+    first[np.cumsum(sizes) - sizes] = True
+    age_index = {age: i for i, age in enumerate(AGES)}
+    occupant_age = np.empty(len(occupant_household), dtype=np.int64)
+    for mask, mix in ((first, householder_ages), (~first, occupant_ages)):
+        codes = np.array([age_index[age] for age in mix])
+        occupant_age[mask] = codes[choose(mix, int(mask.sum()), rng)]
+
+    # shower subtype by penetration, households beyond the total penetration have none
+    subtypes = list(usage_stats['subtype'])
+    penetration = {name: usage_stats['subtype'][name]['penetration'] for name in subtypes}
+    subtype = choose(penetration, households, rng)
+    subtype[rng.random(households)*100 >= usage_stats['penetration']] = -1
+    intensities = np.array([usage_stats['subtype'][name]['intensity'] for name in subtypes])
+    intensity = np.where(subtype >= 0, intensities[subtype], 0.0)
+
+    frequency = usage_stats['frequency']
+    p = np.array([frequency['p'][age] for age in AGES])[occupant_age]
+    df = np.array([durations[age] for age in AGES])[occupant_age]
+    duration_distribution = getattr(rng, usage_stats['duration']['distribution'].lower())
+    frequency_distribution = getattr(rng, frequency['distribution'].lower())
+    dates = np.datetime64(start_date, 'D') + np.arange(days)
+
+    segments = []
+    for day in range(days):
+        weekday = bool(np.is_busday(dates[day]))
+        showers = frequency_distribution(frequency['n'], p)
+        occupant = np.repeat(np.arange(len(occupant_age)), showers)
+        occupant = occupant[intensity[occupant_household[occupant]] > 0]
+        # one schedule per showering occupant, sampled per diurnal group
+        times = np.empty((len(occupant), 4), dtype=np.int64)
+        for age in np.unique(occupant_age[occupant]):
+            members = np.flatnonzero(occupant_age[occupant] == age)
+            group = DIURNAL_GROUPS.get(AGES[age], AGES[age]) if weekday else 'weekend'
+            times[members] = np.array(sample_schedule_times(group, len(members), rng)).T
+        minute = sample_minutes(*times.T, rng.uniform(0, 1, (2, len(occupant))))
+        duration = duration_distribution(df[occupant]).astype(np.int64)
+        start = (day*1440 + minute)*60
+        keep = duration > 0
+        household = occupant_household[occupant][keep]
+        segments.append((household, start[keep], start[keep] + duration[keep]*60,
+                         intensity[household]))
+
+    tank, start, end, rate = (np.concatenate(values) for values in zip(*segments))
+    draws = DrawSchedule(households, *merge_intervals(tank, start, end, rate))
+    population = Population(sizes, subtype, intensity, occupant_household, occupant_age, subtypes,
+                            draws, days)
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        population.save(path)
+    return population
@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+"""
+Preallocated result storage for simulation runs.
+
+ResultBuffer sizes its arrays from the simulation duration up front and is
+filled one time step at a time, so long horizons never hold per-step Python
+objects. Arrays can be kept in memory or memory-mapped to .npy files, stored
+with compact dtypes, and optionally reduced to block averages on the fly.
+"""
+import os
+import numpy as np
+
+class ResultBuffer:
+    # per step: temperature (degC), element power (W) and draw rate (l/min) at
+    # any time step; per day: shower start_times in minutes from midnight
+    fields = ('temperature', 'power', 'draw')
+    default_dtypes = {'temperature': np.float32, 'power': np.uint16, 'draw': np.float32,
+                      'start_times': np.int16}
+
+    def __init__(self, periods, tanks, days=None, dtypes=None, downsample=1, path=None):
+        """Allocate buffers for `periods` time steps of `tanks` heaters.
+
+        dtypes overrides the per-field dtypes in default_dtypes. With
+        downsample > 1 only the mean of every block of `downsample` steps is
+        stored, and power defaults to float32 since block means are fractional.
+        When path is given every field is memory-mapped to path/<field>.npy.
+        """
+        self.periods = int(periods)
+        self.tanks = int(tanks)
+        self.downsample = max(int(downsample), 1)
+        self.path = path
+        self.dtypes = dict(self.default_dtypes)
+        if self.downsample > 1:
+            self.dtypes['power'] = np.float32
+        self.dtypes.update(dtypes or {})
+
+        rows = -(-self.periods//self.downsample)
+        self.data = {}
+        for name in self.fields:
+            self.data[name] = self._allocate(name, (rows, self.tanks))
+        if days is not None:
+            self.data['start_times'] = self._allocate('start_times', (int(days), self.tanks))
+
+        # running block sums used when downsampling
+        self._sums = {name: np.zeros(self.tanks) for name in self.fields}
+        self._count = 0
+        self.row = 0
+        self.period = 0
+
+    def _allocate(self, name, shape):
+        if self.path is None:
+            return np.empty(shape, dtype=self.dtypes[name])
+        os.makedirs(self.path, exist_ok=True)
+        return np.lib.format.open_memmap(os.path.join(self.path, name + '.npy'), mode='w+',
+                                         dtype=self.dtypes[name], shape=shape)
+
+    def nbytes(self):
+        return sum(array.nbytes for array in self.data.values())
+
+    def record(self, temperature, power, draw):
+        """Store the values of a single time step for every heater."""
+        if self.period >= self.periods:
+            raise IndexError("result buffer is full ({0} periods)".format(self.periods))
+        self.period += 1
+        if self.downsample == 1:
+            self.data['temperature'][self.row] = temperature
+            self.data['power'][self.row] = power
+            self.data['draw'][self.row] = draw
+            self.row += 1
+            return
+
+        self._sums['temperature'] += temperature
+        self._sums['power'] += power
+        self._sums['draw'] += draw
+        self._count += 1
+        if self._count == self.downsample:
+            self.flush()
+
+    def record_block(self, temperature, power, draw):
+        """Store consecutive time steps given as (steps, heaters) arrays."""
+        if self.downsample > 1:
+            for row in zip(temperature, power, draw):
+                self.record(*row)
+            return
+        steps = len(temperature)
+        if self.period + steps > self.periods:
+            raise IndexError("result buffer is full ({0} periods)".format(self.periods))
+        self.data['temperature'][self.row:self.row + steps] = temperature
+        self.data['power'][self.row:self.row + steps] = power
+        self.data['draw'][self.row:self.row + steps] = draw
+        self.row += steps
+        self.period += steps
+
+    def record_day(self, day, start_times):
+        if 'start_times' in self.data:
+            self.data['start_times'][day] = start_times
+
+    def flush(self):
+        """Write out any partially filled downsampling block and sync memory maps."""
+        if self._count:
+            for name in self.fields:
+                self.data[name][self.row] = self._sums[name]/self._count
+                self._sums[name][:] = 0
+            self._count = 0
+            self.row += 1
+        self.sync()
+
+    def sync(self):
+        """Write memory-mapped arrays to disk, keeping any open downsampling block."""
+        if self.path is not None:
+            for array in self.data.values():
+                array.flush()
+
+    def rewind(self):
+        """Called when resuming from a checkpoint; rows past self.row are simply overwritten."""
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.path is not None:
+            # memory-mapped arrays are reopened from disk rather than pickled
+            state['data'] = list(self.data)
+        else:
+            # only the filled rows are pickled; the rest is reallocated on load
+            state['data'] = {name: array[:self.row] if name in self.fields else array
+                             for name, array in self.data.items()}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.path is not None:
+            self.data = {name: np.load(os.path.join(self.path, name + '.npy'), mmap_mode='r+')
+                         for name in state['data']}
+            return
+        rows = -(-self.periods//self.downsample)
+        for name in self.fields:
+            filled = state['data'][name]
+            self.data[name] = np.empty((rows, self.tanks), dtype=filled.dtype)
+            self.data[name][:len(filled)] = filled
+
+class FleetAggregator:
+    """Fleet-level load profile reduced on the fly, without per-heater histories.
+
+    Accepts the same record calls as ResultBuffer but keeps only one row per
+    `interval` time steps: mean and peak aggregate element power (kW), the
+    mean fraction of heating elements, tank temperature min/mean/max and
+    quantiles, and the total drawn volume (l). Temperature quantiles come from
+    a fixed-bin histogram sketch covering `temperature_range` in steps of
+    `resolution` degrees, so they are accurate to one bin. Memory use is
+    O(periods/interval) regardless of the number of heaters.
+    """
+
+    def __init__(self, periods, interval=1, time_step=60, quantiles=(0.05, 0.5, 0.95),
+                 temperature_range=(0.0, 100.0), resolution=0.1, capacity=None, days=None):
+        self.periods = int(periods)
+        self.interval = max(int(interval), 1)
+        self.time_step = time_step
+        self.quantiles = np.asarray(quantiles, dtype=np.float64)
+        self.temperature_range = temperature_range
+        self.resolution = resolution
+        # installed element power (W) of the fleet, for load and coincidence factors
+        self.capacity = capacity
+
+        rows = -(-self.periods//self.interval)
+        self.data = {name: np.zeros(rows) for name in
+                     ('power', 'peak_power', 'heating', 'temperature_min', 'temperature_mean',
+                      'temperature_max', 'draw_volume')}
+        self.data['temperature_quantiles'] = np.zeros((rows, len(self.quantiles)))
+        if days is not None:
+            # number of shower starts per hour of every day
+            self.data['start_hours'] = np.zeros((int(days), 24), dtype=np.int64)
+
+        bins = int(round((temperature_range[1] - temperature_range[0])/resolution))
+        self._histogram = np.zeros(bins, dtype=np.int64)
+        self._reset()
+        self.row = 0
+        self.period = 0
+
+    def _reset(self):
+        self._count = 0
+        self._samples = 0
+        self._power = 0.0
+        self._peak = 0.0
+        self._heating = 0.0
+        self._temp_sum = 0.0
+        self._temp_min = np.inf
+        self._temp_max = -np.inf
+        self._draw = 0.0
+        self._histogram[:] = 0
+
+    def record(self, temperature, power, draw):
+        self.record_block(np.asarray(temperature)[None], np.asarray(power)[None], np.asarray(draw)[None])
+
+    def record_block(self, temperature, power, draw):
+        """Reduce consecutive time steps given as (steps, heaters) arrays."""
+        if self.period + len(temperature) > self.periods:
+            raise IndexError("aggregator is full ({0} periods)".format(self.periods))
+        done = 0
+        while done < len(temperature):
+            steps = min(self.interval - self._count, len(temperature) - done)
+            block = slice(done, done + steps)
+            self._reduce(temperature[block], power[block], draw[block])
+            self._count += steps
+            self.period += steps
+            done += steps
+            if self._count == self.interval:
+                self.flush()
+
+    def _reduce(self, temperature, power, draw):
+        total_power = power.sum(axis=1, dtype=np.float64)
+        self._power += total_power.sum()
+        self._peak = max(self._peak, total_power.max())
+        self._heating += np.count_nonzero(power, axis=1).sum()/power.shape[1]
+        self._temp_sum += temperature.sum(dtype=np.float64)
+        self._temp_min = min(self._temp_min, temperature.min())
+        self._temp_max = max(self._temp_max, temperature.max())
+        self._samples += temperature.size
+        # draw is recorded in l/min
+        self._draw += draw.sum(dtype=np.float64) * self.time_step/60
+        low = self.temperature_range[0]
+        index = ((temperature - low)/self.resolution).astype(np.int64).ravel()
+        np.clip(index, 0, len(self._histogram) - 1, out=index)
+        self._histogram += np.bincount(index, minlength=len(self._histogram))
+
+    def sketch_quantiles(self):
+        """Return the quantiles of the current interval's histogram sketch."""
+        cumulative = np.cumsum(self._histogram)
+        target = self.quantiles * cumulative[-1]
+        index = np.minimum(np.searchsorted(cumulative, target, side='left'), len(cumulative) - 1)
+        below = np.where(index > 0, cumulative[index - 1], 0)
+        fraction = (target - below)/np.maximum(self._histogram[index], 1)
+        return self.temperature_range[0] + (index + fraction)*self.resolution
+
+    def record_day(self, day, start_times):
+        if 'start_hours' in self.data:
+            start_times = np.asarray(start_times, dtype=np.int64)
+            # start times are minutes from midnight, negative for tanks without a draw that day
+            hours = (start_times[start_times >= 0]//60) % 24
+            self.data['start_hours'][day] = np.bincount(hours, minlength=24)
+
+    def flush(self):
+        """Close the current (possibly partial) interval."""
+        if not self._count:
+            return
+        self.data['power'][self.row] = self._power/self._count/1000
+        self.data['peak_power'][self.row] = self._peak/1000
+        self.data['heating'][self.row] = self._heating/self._count
+        self.data['temperature_min'][self.row] = self._temp_min
+        self.data['temperature_mean'][self.row] = self._temp_sum/self._samples
+        self.data['temperature_max'][self.row] = self._temp_max
+        self.data['temperature_quantiles'][self.row] = self.sketch_quantiles()
+        self.data['draw_volume'][self.row] = self._draw
+        self.row += 1
+        self._reset()
+
+    def sync(self):
+        pass
+
+    def rewind(self):
+        pass
+
+    def coincidence_factor(self):
+        """Peak aggregate demand over the installed element capacity."""
+        if self.capacity is None:
+            raise ValueError("coincidence factor requires the fleet capacity")
+        return self.data['peak_power'][:self.row].max()*1000/self.capacity
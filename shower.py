@@ -1,10 +1,7 @@
-import os
-import toml
-import pandas as pd
 import numpy as np
 import random
+import stats_registry
 from dataclasses import dataclass, field
-from settings import DATA_PATH
 from bisect import bisect_left
 
 def take_closest(myList, myNumber):
@@ -25,6 +22,35 @@ def take_closest(myList, myNumber):
     else:
         return before
 
+def cdf_table(users):
+    """Stack the users' schedule CDFs into a (schedules, minutes) array.
+
+    Users sharing a schedule share a row. Returns the table and the row of
+    every user.
+    """
+    rows = {}
+    user_rows = np.empty(len(users), dtype=np.int64)
+    for i, user in enumerate(users):
+        user_rows[i] = rows.setdefault(id(user.schedule), len(rows))
+    table = np.empty((len(rows), len(users[0].schedule.cdf)))
+    for user in users:
+        table[rows[id(user.schedule)]] = np.asarray(user.schedule.cdf)
+    return table, user_rows
+
+def sample_start_times(table, rows, uniforms):
+    """Invert the CDF rows of `table` at `uniforms` with a single searchsorted call.
+
+    uniforms is a (samples, len(rows)) array; returns the sampled minutes.
+    Each row is offset by twice its index so all rows can be searched as one
+    sorted array.
+    """
+    minutes = table.shape[1]
+    offsets = 2.0*np.arange(len(table))
+    flat = (table + offsets[:, None]).ravel()
+    index = np.searchsorted(flat, uniforms + offsets[rows], side='left')
+    # guard against CDFs that sum to slightly less than one
+    return np.minimum(index - rows*minutes, minutes - 1)
+
 @dataclass
 class Shower():
     name: str = "NormalShower"  
@@ -32,46 +58,87 @@ class Shower():
 
     def __post_init__(self):
         #self.name = "Shower"
-        self.diurnal_stats = toml.load(open(os.path.join(DATA_PATH, 'diurnal_distributions.toml'), 'r'))
-        self.usage_stats = toml.load(open(os.path.join(DATA_PATH, 'end_uses', 'shower.toml'), 'r'))
+        # statistics are shared through the registry and must not be modified
+        self.diurnal_stats = stats_registry.load_toml(stats_registry.DIURNAL_PATH)
+        self.usage_stats = stats_registry.load_toml(stats_registry.SHOWER_PATH)
+        self.duration_df = stats_registry.shower_durations()
 
-    def frequency(self):
+    def frequency(self, rng=None):
+        # sample from the global numpy random state unless a Generator is given
+        rng = np.random if rng is None else rng
         # load shower frequency stats
         freq_stats = self.usage_stats['frequency']
         # select frequency distribution function from shower stats
-        distribution = getattr(np.random, freq_stats['distribution'].lower())
+        distribution = getattr(rng, freq_stats['distribution'].lower())
         # assign 'n' and 'p' values for binomial distribution
         n = freq_stats['n']
         p = freq_stats['p'][self.user_age]
 
         return distribution(n, p)
 
-    def duration_intensity(self, user_age):
+    def duration_intensity(self, user_age, rng=None):
+        rng = np.random if rng is None else rng
         duration_stats = self.usage_stats['duration']
         # select frequency distribution function
-        distribution = getattr(np.random, duration_stats['distribution'].lower())
-        # parse time 'str' into Timedelta object and convert to minutes
-        df = int(pd.Timedelta(duration_stats['df'][user_age]).total_seconds() / 60)
+        distribution = getattr(rng, duration_stats['distribution'].lower())
+        # duration parameter in minutes, pre-parsed by the statistics registry
+        df = self.duration_df[user_age]
         # sample shower duration value using statistical distribution
         sampled_duration = distribution(df)
-        duration = int(pd.Timedelta(minutes=sampled_duration).total_seconds()/60)
+        # whole minutes, truncated as in simulate_batch
+        duration = int(sampled_duration)
         
         intensity = self.usage_stats['subtype'][self.name]['intensity']
         return duration, intensity
 
-    def simulate(self, user):
-        duration, intensity = self.duration_intensity(user.age)
+    def simulate(self, user, rng=None):
+        duration, intensity = self.duration_intensity(user.age, rng=rng)
         cdf = user.schedule.cdf
         # randomly sample unique cdf value
-        cdf_select = np.random.uniform(0, 1)
-        cdf_sample = take_closest(cdf.values, cdf_select)
+        cdf_select = (np.random if rng is None else rng).uniform(0, 1)
+        cdf_sample = take_closest(cdf, cdf_select)
         #cdf_val = cdf[cdf==random.sample(list(set(cdf)), 1)[0]]
-        cdf_val = cdf[cdf==cdf_sample]
+        # minutes of the day sharing the sampled cdf value
+        cdf_val = np.flatnonzero(cdf==cdf_sample)
         if len(cdf_val) > 1:
-            start = int(cdf_val.sample().index[0].total_seconds() / 60)
+            start = int((np.random if rng is None else rng).choice(cdf_val))
         else:
-            start = int(cdf_val.index[0].total_seconds() / 60)
+            start = int(cdf_val[0])
         #start = int(np.cumsum(user.schedule.pdf).sample().index[0].total_seconds() / 60)
         end = start + duration
         
         return start, end, intensity
+
+    def simulate_batch(self, users, days=1, rng=None, apply_frequency=False, table=None):
+        """Sample `days` shower events for every user in single vectorized calls.
+
+        Start times are drawn by inverting each user's schedule CDF with
+        np.searchsorted, so unlike simulate a start never falls in a
+        zero-probability minute. When apply_frequency is True, days where the
+        binomial frequency from shower.toml gives no shower have zero
+        intensity. table is an optional precomputed cdf_table(users).
+        Returns start, end and intensity arrays of shape (days, len(users)).
+        """
+        rng = np.random if rng is None else rng
+        if not isinstance(users, (list, tuple)):
+            users = [users]
+        if table is None:
+            table = cdf_table(users)
+        shape = (days, len(users))
+
+        # per-user distribution parameters
+        ages = [user.age for user in users]
+        duration_stats = self.usage_stats['duration']
+        freq_stats = self.usage_stats['frequency']
+        df = np.array([self.duration_df[age] for age in ages])
+
+        distribution = getattr(rng, duration_stats['distribution'].lower())
+        duration = distribution(df, size=shape).astype(np.int64)
+        start = sample_start_times(table[0], table[1], rng.uniform(0, 1, size=shape))
+        intensity = np.full(shape, self.usage_stats['subtype'][self.name]['intensity'])
+        if apply_frequency:
+            p = np.array([freq_stats['p'][age] for age in ages])
+            distribution = getattr(rng, freq_stats['distribution'].lower())
+            intensity[distribution(freq_stats['n'], p, size=shape) == 0] = 0.0
+
+        return start, start + duration, intensity
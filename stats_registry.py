@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+Process-wide registry of parsed end-use and diurnal statistics.
+
+Each TOML file is read once per process and the derived objects (frozen
+distributions per age group, shower duration parameters) are built once
+and shared by every User, UserSchedule and Shower instance. Entries record the
+file modification time when loaded; refresh() drops entries whose file has
+changed since and invalidate() drops entries explicitly.
+"""
+import os
+import threading
+import numpy as np
+import toml
+from settings import DATA_PATH
+
+DIURNAL_PATH = os.path.join(DATA_PATH, 'diurnal_distributions.toml')
+SHOWER_PATH = os.path.join(DATA_PATH, 'end_uses', 'shower.toml')
+
+# (path, name) -> (mtime, value)
+_entries = {}
+_lock = threading.RLock()
+
+def cached(path, name, build):
+    """Return the registry entry `name` for path, building it with build(path) on first use."""
+    key = (os.path.abspath(path), name)
+    entry = _entries.get(key)
+    if entry is not None:
+        return entry[1]
+    with _lock:
+        if key not in _entries:
+            mtime = os.path.getmtime(path)
+            _entries[key] = (mtime, build(path))
+        return _entries[key][1]
+
+def invalidate(path=None):
+    """Drop every entry derived from path, or the whole registry when path is None."""
+    with _lock:
+        if path is None:
+            _entries.clear()
+            return
+        path = os.path.abspath(path)
+        for key in [key for key in _entries if key[0] == path]:
+            del _entries[key]
+
+def refresh():
+    """Drop entries whose source file has been modified since it was loaded."""
+    with _lock:
+        for key, (mtime, value) in list(_entries.items()):
+            if not os.path.exists(key[0]) or os.path.getmtime(key[0]) != mtime:
+                del _entries[key]
+
+def _read_toml(path):
+    with open(path, 'r') as toml_file:
+        return toml.load(toml_file)
+
+def load_toml(path):
+    """Return the parsed TOML file. The result is shared and must not be modified."""
+    return cached(path, 'toml', _read_toml)
+
+# minutes per unit of the '<number> <unit>' duration strings
+_units = {'second': 1/60, 'minute': 1, 'hour': 60, 'day': 1440}
+
+def to_minutes(value):
+    """Convert a duration string such as '07:00:00' or '8.6 Minutes' to minutes.
+
+    The two formats used by the statistics files are parsed directly; other
+    strings accepted by pandas.Timedelta fall back to pandas.
+    """
+    text = str(value).strip()
+    try:
+        if text.count(':') == 2:
+            hours, minutes, seconds = (float(part) for part in text.split(':'))
+            return (hours*3600 + minutes*60 + seconds) / 60
+        number, unit = text.split()
+        unit = unit.lower().rstrip('s')
+        if unit in _units:
+            return float(number)*_units[unit]
+    except ValueError:
+        pass
+    import pandas as pd
+
+    return pd.Timedelta(value).total_seconds() / 60
+
+class Normal:
+    """Normal distribution with the rvs interface of a frozen scipy.stats.norm.
+
+    Draws the same values as scipy for the same random state.
+    """
+
+    def __init__(self, loc=0.0, scale=1.0):
+        self.loc = loc
+        self.scale = scale
+
+    def rvs(self, size=None, random_state=None):
+        rng = np.random if random_state is None else random_state
+        return rng.standard_normal(size) * self.scale + self.loc
+
+# distributions available without scipy
+_distributions = {'norm': Normal}
+
+def diurnal_samplers(group, path=DIURNAL_PATH):
+    """Return the frozen distributions (in minutes) of a diurnal pattern group.
+
+    The keys are the activity names of the group, e.g. 'getting_up' or 'sleep'.
+    Normal distributions are sampled with NumPy, other scipy.stats
+    distribution names import scipy on first use.
+    """
+    def build(path):
+        samplers = {}
+        for key, val in load_toml(path)[group].items():
+            dist = _distributions.get(val['dist'])
+            if dist is None:
+                import scipy.stats as sci_stats
+
+                dist = getattr(sci_stats, val['dist'])
+            samplers[key] = dist(loc=round(to_minutes(val['mu'])), scale=round(to_minutes(val['sd'])))
+        return samplers
+
+    return cached(path, ('diurnal_samplers', group), build)
+
+def shower_durations(path=SHOWER_PATH):
+    """Return the shower duration distribution parameter per age group, in whole minutes."""
+    def build(path):
+        duration_stats = load_toml(path)['duration']
+        return {age: int(to_minutes(df)) for age, df in duration_stats['df'].items()}
+
+    return cached(path, 'shower_durations', build)
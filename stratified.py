@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+Stratified (multi-node) EWH fleet model.
+
+StratifiedFleet splits every tank into `nodes` horizontal layers of equal
+volume, numbered from the bottom (inlet) to the top (outlet). Each step applies:
+
+- standing losses to ambient, with the tank's loss coefficient shared evenly
+  between the layers so every layer decays like the single-node tank,
+- plug-flow draw, where the drawn volume is pushed up through the layers and
+  inlet water enters at the bottom,
+- the heating element, which heats the layer holding element_node and is
+  switched by the thermostat at sensor_node, followed by buoyant
+  rearrangement so warmer water rises above colder water,
+- conduction between adjacent layers.
+
+Conduction between layers is the tridiagonal system dT/dt = -r L T, where L is
+the same (Neumann) second-difference matrix for every tank and r is the
+per-tank conduction number. L is diagonalised by the orthonormal DCT-II basis,
+so the exact update over a time step is two (tanks, nodes) x (nodes, nodes)
+matrix products, with no loop over nodes or tanks.
+
+The fleet shares the EWHFleet interface and is accepted by Simulation.run.
+current_temp is the mean temperature of the layers, and assigning it sets
+every layer to that temperature. With nodes=1 the model reduces to EWHFleet.
+"""
+import numpy as np
+from ewh_sim import specific_heat_cap
+from fleet import EWHFleet
+
+def conduction_basis(nodes):
+    """Return the orthonormal DCT-II basis and the eigenvalues of the node second-difference matrix."""
+    j = np.arange(nodes)[:, None] + 0.5
+    k = np.arange(nodes)[None, :]
+    basis = np.sqrt(2.0/nodes) * np.cos(np.pi*j*k/nodes)
+    basis[:, 0] = np.sqrt(1.0/nodes)
+    eigenvalues = 4 * np.sin(np.pi*np.arange(nodes)/(2*nodes))**2
+    return basis, eigenvalues
+
+def plug_flow(node_temp, shift, inlet_temp):
+    """Push `shift` layers of inlet water into the bottom of every tank.
+
+    The cumulative heat profile is shifted up the tank, with inlet water below
+    the bottom layer. Returns the new (tanks, nodes) layer temperatures and
+    the mean temperature of the water that left through the top.
+    """
+    tanks, nodes = node_temp.shape
+    # cumulative heat content (in layer-degrees) at every layer boundary
+    heat = np.zeros((tanks, nodes + 1))
+    np.cumsum(node_temp, axis=1, out=heat[:, 1:])
+    position = np.arange(nodes + 1)[None, :] - shift[:, None]
+    layer = np.clip(np.floor(position).astype(np.int64), 0, nodes - 1)
+    shifted = (np.take_along_axis(heat, layer, axis=1)
+               + (position - layer)*np.take_along_axis(node_temp, layer, axis=1))
+    shifted = np.where(position < 0, inlet_temp[:, None]*position, shifted)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        outlet_temp = np.where(shift > 0, (heat[:, -1] - shifted[:, -1])/shift, node_temp[:, -1])
+    return np.diff(shifted, axis=1), outlet_temp
+
+class StratifiedFleet(EWHFleet):
+    def __init__(self, size=1, nodes=10, height=1.2, conductivity=0.644, element_node=None,
+                 sensor_node=None, **kwargs):
+        """Create `size` tanks of `nodes` layers.
+
+        height is the water column height (m) and conductivity the effective
+        vertical conductivity (W/m.K) of the water between layers. The element
+        and thermostat sit in the layers element_node and sensor_node,
+        counted from the bottom, both defaulting to the lowest quarter of the tank.
+        """
+        self.nodes = int(nodes)
+        super().__init__(size=size, **kwargs)
+        self.height = self._column(height)
+        self.conductivity = self._column(conductivity)
+        default_node = self.nodes//4
+        self.element_node = default_node if element_node is None else int(element_node)
+        self.sensor_node = self.element_node if sensor_node is None else int(sensor_node)
+        self.basis, self.eigenvalues = conduction_basis(self.nodes)
+        self._conduction = (None, None)
+        # mean temperature of the water leaving the tank in the last step
+        self.outlet_temp = self.node_temp[:, -1].copy()
+
+    @property
+    def current_temp(self):
+        return self.node_temp.mean(axis=1)
+
+    @current_temp.setter
+    def current_temp(self, value):
+        self.node_temp = np.empty((self.size, self.nodes))
+        self.node_temp[:] = np.asarray(value, dtype=np.float64)[..., None]
+
+    @property
+    def sensor_temp(self):
+        return self.node_temp[:, self.sensor_node]
+
+    def conduction_decay(self, time_step):
+        """Return the (tanks, nodes) decay factor of every conduction mode over a time step."""
+        # conductance between layers of cross-section A and thickness height/nodes
+        area = (self.volume/1000)/self.height
+        conductance = self.conductivity*area*self.nodes/self.height
+        node_capacity = specific_heat_cap*self.mass/self.nodes
+        rate = conductance*time_step/node_capacity
+        return np.exp(-rate[:, None]*self.eigenvalues[None, :])
+
+    def conduct(self, time_step, decay=None):
+        if decay is None:
+            # reuse the decay factors while the time step and tank geometry are unchanged
+            key = (time_step, self.mass.tobytes(), self.volume.tobytes(), self.height.tobytes(),
+                   self.conductivity.tobytes())
+            if self._conduction[0] != key:
+                self._conduction = (key, self.conduction_decay(time_step))
+            decay = self._conduction[1]
+        return ((self.node_temp @ self.basis)*decay) @ self.basis.T
+
+    def standing_loss(self, ambient_temperature, time_step, decay=None):
+        if decay is None:
+            decay = self.calculate_decay(time_step)
+        return ambient_temperature + ((self.node_temp-ambient_temperature)*decay[:, None])
+
+    def draw_event_loss(self, draw_rate=None, *, time_step):
+        """Return the layer temperatures after pushing the drawn volume through the tank.
+
+        Also sets outlet_temp to the mean temperature of the water that left
+        through the top.
+        """
+        if draw_rate is None:
+            draw_rate = self.draw_rate
+        shift = np.broadcast_to(draw_rate*time_step*self.nodes/self.volume, (self.size,))
+        node_temp, self.outlet_temp = plug_flow(self.node_temp, shift, self.inlet_temp)
+        return node_temp
+
+    def increase_temp(self, time_step):
+        energy = self.element_rating * time_step
+        node_temp = self.node_temp.copy()
+        node_temp[:, self.element_node] += energy*self.nodes/(specific_heat_cap*self.mass)
+        return node_temp
+
+    def update_element(self, time_step, heat_gain=None):
+        """Apply the thermostat hysteresis at the sensor layer and return element power (W).
+
+        heat_gain is the whole-tank temperature rise per step, as for EWHFleet;
+        it is concentrated in the element layer and spread upwards by buoyancy.
+        """
+        if heat_gain is None:
+            heat_gain = (self.element_rating * time_step)/(specific_heat_cap*self.mass)
+        limit = np.where(self.element_on, self.upper_temp_limit, self.lower_temp_limit)
+        heating = self.is_active & (self.sensor_temp < limit)
+        self.element_on = np.where(self.is_active, heating, self.element_on)
+        self.node_temp[:, self.element_node] += np.where(heating, heat_gain*self.nodes, 0.0)
+        # heated water rises until the column is stably stratified
+        self.node_temp.sort(axis=1)
+        return np.where(heating, self.element_rating, 0.0)
+
+    def step(self, ambient_temperature, draw_rate, time_step, decay=None, heat_gain=None,
+             conduction=None):
+        """Advance every tank by one time step and return the element power (W).
+
+        draw_rate is the per-tank draw in l/s, drawn for the whole time step
+        as in EWHFleet.step. conduction optionally holds the precomputed
+        conduction_decay(time_step).
+        """
+        self.node_temp = self.standing_loss(ambient_temperature, time_step, decay)
+        draw_rate = np.broadcast_to(np.asarray(draw_rate, dtype=np.float64), (self.size,))
+        self.draw_event = draw_rate > 0
+        # only the drawing tanks are shifted
+        drawing = np.flatnonzero(self.draw_event)
+        self.outlet_temp = self.node_temp[:, -1].copy()
+        if len(drawing):
+            shift = draw_rate[drawing]*time_step*self.nodes/self.volume[drawing]
+            self.node_temp[drawing], self.outlet_temp[drawing] = plug_flow(
+                self.node_temp[drawing], shift, self.inlet_temp[drawing])
+        power = self.update_element(time_step, heat_gain)
+        self.node_temp = self.conduct(time_step, conduction)
+        return power
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+Parameter sweep and Monte Carlo executor.
+
+Scenarios (heater config x user profile x weather window x replica) are fanned
+out over a process pool. Every scenario draws from its own
+numpy.random.Generator, spawned from a single root SeedSequence by scenario
+index, so results are reproducible regardless of the number of worker
+processes or the order in which they finish.
+"""
+import itertools
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+import ewh_sim
+from weather import WeatherSource
+
+@dataclass
+class Scenario:
+    # keyword arguments for ewh_sim.EWH
+    heater: dict = field(default_factory=dict)
+    age: str = 'work_ad'
+    tanks: int = 1
+    # hour offset into the weather record, ignored when the sweep has no weather
+    weather_start: int = 0
+    # draw heater settings with EWH.randomise_settings
+    randomised: bool = False
+    replica: int = 0
+
+def build_scenarios(heaters=({},), ages=('work_ad',), weather_starts=(0,), replicas=1,
+                    tanks=1, randomised=False):
+    """Return the cartesian product of heater configs, user ages, weather windows and replicas."""
+    return [Scenario(heater=dict(heater), age=age, tanks=tanks, weather_start=weather_start,
+                     randomised=randomised, replica=replica)
+            for heater, age, weather_start, replica
+            in itertools.product(heaters, ages, weather_starts, range(replicas))]
+
+def run_scenario(scenario, seed, days, time_step, weather=None, cache=None):
+    """Simulate a single scenario with a Generator seeded from `seed`.
+
+    With cache (a cache.ResultCache) an unchanged scenario is loaded from disk.
+    """
+    import shower
+    import user
+
+    rng = np.random.default_rng(seed)
+    ewhs = []
+    for tank in range(scenario.tanks):
+        ewh = ewh_sim.EWH(**scenario.heater)
+        if scenario.randomised:
+            ewh.randomise_settings(rng)
+        ewh.initialise_temp(rng)
+        ewhs.append(ewh)
+    users = [user.User(age=scenario.age, rng=rng) for tank in range(scenario.tanks)]
+    if weather is not None:
+        weather = WeatherSource(np.roll(weather.temperatures, -scenario.weather_start))
+
+    sim = ewh_sim.Simulation(days=days, temp_variance=weather is not None, time_step=time_step)
+    if cache is not None:
+        return cache.run(sim, ewhs, users, weather=weather, shower=shower.Shower(), rng=rng)
+    return sim.run(ewhs, users, weather=weather, shower=shower.Shower(), rng=rng)
+
+def merge_results(scenarios, results):
+    """Concatenate per-scenario result arrays along the heater axis.
+
+    The merged dataset has a 'scenario' array giving the scenario index of
+    every heater column.
+    """
+    merged = {name: np.concatenate([result[name] for result in results], axis=1)
+              for name in results[0]}
+    merged['scenario'] = np.repeat(np.arange(len(scenarios)),
+                                   [scenario.tanks for scenario in scenarios])
+    return merged
+
+def run_sweep(scenarios, days=1, time_step=60, weather=None, seed=None, processes=None, cache=None):
+    """Run every scenario, in parallel when processes != 1, and merge the results.
+
+    weather is an optional weather.WeatherSource shared by all scenarios, each
+    reading it from its own weather_start. seed is the root entropy of the
+    sweep; the same seed and scenarios always give the same dataset. cache
+    is an optional cache.ResultCache shared by the workers.
+    Returns (merged results, root SeedSequence).
+    """
+    scenarios = list(scenarios)
+    root = np.random.SeedSequence(seed)
+    seeds = root.spawn(len(scenarios))
+    args = (scenarios, seeds, [days]*len(scenarios), [time_step]*len(scenarios),
+            [weather]*len(scenarios), [cache]*len(scenarios))
+
+    if processes == 1:
+        results = list(map(run_scenario, *args))
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            results = list(executor.map(run_scenario, *args))
+    return merge_results(scenarios, results), root
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+"""Controller decisions must not depend on the engine running the fleet."""
+import numpy as np
+import pytest
+import ewh_sim
+import fleet
+import population
+from controllers import TimeOfUseController
+from results import ResultBuffer
+
+@pytest.mark.parametrize('interval', [1, 5, 7, 1441])
+def test_step_and_kernel_engines_match_under_controller(interval):
+    draws = population.generate(50, days=2, seed=0).draws
+    results = []
+    for engine in ('step', 'kernel'):
+        heaters = fleet.EWHFleet(50, always_on=True)
+        heaters.randomise_settings(np.random.default_rng(0))
+        results.append(ewh_sim.Simulation(time_step=60).run(
+            heaters, None, days=2, draws=draws, engine=engine,
+            controller=TimeOfUseController(interval=interval), results=ResultBuffer(2880, 50, days=2)))
+    step, kernel = results
+    assert np.array_equal(step['power'], kernel['power'])
+    assert np.array_equal(step['temperature'], kernel['temperature'])
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+"""A co-simulated run must take one decision per interval and act on the commands it gets back."""
+import numpy as np
+import pytest
+import cosim
+import ewh_sim
+import fleet
+import population
+from results import ResultBuffer
+
+TANKS = 50
+DAYS = 1
+
+@pytest.fixture(scope='module')
+def draws():
+    return population.generate(TANKS, days=DAYS, seed=0).draws
+
+def run(draws, policy=None, interval=None, engine='step'):
+    heaters = fleet.EWHFleet(TANKS, always_on=True)
+    heaters.randomise_settings(np.random.default_rng(0))
+    simulation = ewh_sim.Simulation(time_step=60)
+    results = ResultBuffer(1440*DAYS, TANKS, days=DAYS)
+    if interval is None:
+        return simulation.run(heaters, None, days=DAYS, draws=draws, engine=engine, results=results), None
+    return cosim.run_with_stub(simulation, heaters, None, policy, days=DAYS, draws=draws, engine=engine,
+                               interval=interval, results=results)
+
+@pytest.mark.parametrize('interval', [1, 5, 7])
+def test_one_decision_per_interval(draws, interval):
+    _, summary = run(draws, interval=interval)
+    assert summary['decisions'] == -(-1440*DAYS//interval)
+
+@pytest.mark.parametrize('engine', ['step', 'kernel'])
+def test_commands_change_element_state(draws, engine):
+    uncontrolled, _ = run(draws, engine=engine)
+    # commands keeping every setting leave the run untouched
+    unchanged, _ = run(draws, interval=5, engine=engine)
+    assert np.array_equal(unchanged['power'], uncontrolled['power'])
+    assert np.array_equal(unchanged['temperature'], uncontrolled['temperature'])
+
+    limit = 5
+    controlled, _ = run(draws, cosim.coldest_first(limit), interval=5, engine=engine)
+    uncontrolled_on = (uncontrolled['power'] > 0).sum(axis=1)
+    controlled_on = (controlled['power'] > 0).sum(axis=1)
+    assert uncontrolled_on.max() > limit
+    assert controlled_on.max() <= limit
+    assert not np.array_equal(controlled['power'], uncontrolled['power'])
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""The kernel loops must reproduce the scalar EWH stepping of main.py exactly."""
+import importlib.util
+import numpy as np
+import pytest
+import fleet
+import kernel
+
+numba_missing = importlib.util.find_spec('numba') is None
+
+def reference_loop(ewhs, ambient, draw_rate, time_step):
+    """Step EWH objects with standing_loss, draw_event_loss, increase_temp and main.py's hysteresis."""
+    temperature = np.empty(draw_rate.shape)
+    power = np.empty(draw_rate.shape)
+    for t in range(len(ambient)):
+        for i, ewh in enumerate(ewhs):
+            ewh.current_temp = ewh.standing_loss(ambient[t], time_step)
+            if draw_rate[t, i] > 0:
+                ewh.current_temp = ewh.draw_event_loss(draw_rate=draw_rate[t, i], time_step=time_step)
+            step_power = 0
+            if ewh.is_active:
+                if ewh.element_on:
+                    if ewh.current_temp < ewh.upper_temp_limit:
+                        ewh.current_temp = ewh.increase_temp(time_step)
+                        step_power = ewh.element_rating
+                    else:
+                        ewh.element_on = False
+                else:
+                    if ewh.current_temp < ewh.lower_temp_limit:
+                        ewh.element_on = True
+                        ewh.current_temp = ewh.increase_temp(time_step)
+                        step_power = ewh.element_rating
+            temperature[t, i] = ewh.current_temp
+            power[t, i] = step_power
+    return temperature, power
+
+@pytest.mark.parametrize('jit', [False, pytest.param(True, marks=pytest.mark.skipif(
+    numba_missing, reason="the compiled loop requires Numba"))])
+@pytest.mark.parametrize('time_step', [60, 5])
+def test_loop_matches_ewh_methods(time_step, jit):
+    tanks, periods = 40, 1440
+    rng = np.random.default_rng(0)
+    heaters = fleet.EWHFleet(tanks, always_on=True)
+    heaters.randomise_settings(rng)
+    heaters.initialise_temp(rng)
+    # some tanks are switched off for the whole run
+    heaters.is_active = rng.random(tanks) < 0.9
+    ambient = rng.uniform(0, 35, periods)
+    draw_rate = np.where(rng.random((periods, tanks)) < 0.02, 0.142, 0.0)
+
+    ewhs = heaters.to_ewhs()
+    temperature, power = kernel.simulate(heaters, ambient, draw_rate, time_step, jit=jit)
+    expected_temperature, expected_power = reference_loop(ewhs, ambient, draw_rate, time_step)
+
+    assert np.array_equal(temperature, expected_temperature)
+    assert np.array_equal(power, expected_power)
+    assert np.array_equal(heaters.current_temp, [ewh.current_temp for ewh in ewhs])
+    assert np.array_equal(heaters.element_on, [ewh.element_on for ewh in ewhs])
@@ -1,27 +1,182 @@
-import os
-import toml
-import copy
 import numpy as np
-import scipy.stats as sci_stats
-import pandas as pd
-import matplotlib.pyplot as plt
-import utils
-from matplotlib.dates import DateFormatter
+from collections import OrderedDict
 from dataclasses import dataclass, field
-from typing import Any, Callable, Literal
-from settings import DATA_PATH
-import random
+from datetime import timedelta
+from typing import Any, Literal
+import stats_registry
+
+def sample_schedule_times(group, size, rng=None):
+    """Sample up, go, home and sleep times (minutes) for `size` schedules of a diurnal group.
+
+    Applies the same adjustments as UserSchedule.__post_init__ to whole arrays.
+    """
+    samplers = stats_registry.diurnal_samplers(group)
+
+    def sample(key):
+        return np.round(samplers[key].rvs(size=size, random_state=rng)).astype(np.int64)
+
+    up = sample('getting_up')
+    sleep = sample('getting_up') - sample('sleep') + 1440
+    go = sample('leaving_house')
+    go = np.where(go < up, up + 30, go)
+    home = go + sample('being_away')
+    # did not leave home
+    home = np.where(home < go, go, home)
+    home = np.where(sleep < home, sleep - 30, home)
+    return up, go, home, sleep
+
+def paint_schedule(up, go, home, sleep, minutes, peak=0.65, normal=0.335, away=0.0, night=0.015):
+    """Return the unnormalised usage weight of schedules at the given minutes of the day.
+
+    minutes has one trailing axis more than the schedule arrays (or is 1-D
+    and shared by all schedules). Minutes outside every activity are NaN.
+    """
+    up, go, home, sleep = np.broadcast_arrays(*(np.asarray(x, dtype=np.int64) for x in (up, go, home, sleep)))
+    minutes = np.asarray(minutes)
+    pdf = np.full(np.broadcast_shapes(up.shape + (1,), minutes.shape), np.nan)
+
+    def paint(value, a, b, rows=True):
+        # assign value to the minutes [a, b), wrapping around midnight when a >= b
+        a = np.asarray(a)[..., None]
+        b = np.asarray(b)[..., None]
+        # exactly one of the two bounds holds outside [a, b) when a < b, and inside it otherwise
+        inside = (minutes >= a) ^ (minutes < b) ^ (a < b)
+        np.copyto(pdf, value, where=inside & np.asarray(rows)[..., None])
+
+    up_p30 = (up + 30) % 1440
+    up = up % 1440
+    go_m30 = (go - 30) % 1440
+    go = go % 1440
+    home_p30 = (home + 30) % 1440
+    home = home % 1440
+    sleep_day, sleep = np.divmod(sleep, 1440)
+    late = sleep_day >= 1
+    sleep_m30 = (sleep - 30) % 1440
+
+    paint(normal, up_p30, go_m30)
+    paint(peak, up, up_p30)
+    paint(peak, go_m30, go)
+    paint(peak, home, home_p30)
+    paint(away, go, home)
+    # sleeping after midnight
+    paint(normal, home_p30, 1440, late)
+    paint(night, 1440, up, late)
+    # sleeping before midnight
+    paint(normal, home_p30, sleep_m30, ~late)
+    paint(peak, sleep_m30, sleep, ~late)
+    paint(night, sleep, up, ~late)
+    return pdf
+
+def build_pdf(up, go, home, sleep, peak=0.65, normal=0.335, away=0.0, night=0.015):
+    """Return the water usage pdf over the 1,440 minutes of the day.
+
+    up, go, home and sleep are minutes from midnight, with sleep on the next
+    day counted past 1440. They may be scalars, giving a (1440,) pdf, or
+    equal-length arrays, giving one row per schedule.
+    """
+    pdf = paint_schedule(up, go, home, sleep, np.arange(1440), peak=peak, normal=normal,
+                         away=away, night=night)
+    # normalize stats to produce pdf
+    return pdf / np.nansum(pdf, axis=-1, keepdims=True)
+
+def sample_minutes(up, go, home, sleep, uniforms, peak=0.65, normal=0.335, away=0.0, night=0.015):
+    """Sample one minute of the day from each schedule's pdf without building it.
+
+    The pdf is constant between the schedule's activity boundaries, so an
+    interval is chosen by its probability mass and a minute uniformly within
+    it, giving the same distribution as inverting the 1,440-minute cdf.
+    uniforms is a (2, schedules) array of uniform [0, 1) variates.
+    """
+    up, go, home, sleep = np.broadcast_arrays(*(np.asarray(x, dtype=np.int64) for x in (up, go, home, sleep)))
+    bounds = np.stack([np.zeros_like(up), up, up + 30, go - 30, go, home, home + 30, sleep - 30,
+                       sleep], axis=-1) % 1440
+    bounds.sort(axis=-1)
+    bounds = np.concatenate([bounds, np.full(up.shape + (1,), 1440)], axis=-1)
+    starts = bounds[..., :-1]
+    weight = paint_schedule(up, go, home, sleep, starts, peak=peak, normal=normal, away=away,
+                            night=night)
+    mass = np.cumsum(np.nan_to_num(weight)*np.diff(bounds, axis=-1), axis=-1)
+    interval = (mass <= uniforms[0][..., None]*mass[..., -1:]).sum(axis=-1)
+    interval = np.minimum(interval, starts.shape[-1] - 1)
+    start = np.take_along_axis(starts, interval[..., None], axis=-1)[..., 0]
+    length = np.take_along_axis(bounds, interval[..., None] + 1, axis=-1)[..., 0] - start
+    return start + (uniforms[1]*length).astype(np.int64)
+
+def sample_pdfs(group, size, rng=None, peak=0.65, normal=0.335, away=0.0, night=0.015):
+    """Sample `size` schedules of a diurnal group and return their (pdf, cdf) arrays."""
+    pdf = build_pdf(*sample_schedule_times(group, size, rng), peak=peak, normal=normal,
+                    away=away, night=night)
+    return pdf, np.cumsum(pdf, axis=-1)
+
+class ScheduleCache:
+    """Bounded LRU cache of schedule cdf arrays for per-day schedule regeneration.
+
+    Sampled up/go/home/sleep times are quantized to `resolution` minutes and
+    the (up, go, home, sleep, weekday) signature is used as the cache key, so
+    a population that is resampled every day only builds schedules it has
+    not seen recently. Each entry holds one 1,440-minute cdf (about 11 kB).
+    """
+
+    def __init__(self, maxsize=4096, resolution=15, peak=0.65, normal=0.335, away=0.0, night=0.015):
+        self.maxsize = maxsize
+        self.resolution = resolution
+        self.weights = dict(peak=peak, normal=normal, away=away, night=night)
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, signatures):
+        """Return the cdf of every signature, building missing ones in one batch."""
+        missing = list(dict.fromkeys(key for key in signatures if key not in self.entries))
+        self.misses += len(missing)
+        self.hits += len(signatures) - len(missing)
+        if missing:
+            pdfs = build_pdf(*np.array([key[:4] for key in missing]).T, **self.weights)
+            for key, cdf in zip(missing, np.cumsum(pdfs, axis=-1)):
+                self.entries[key] = cdf
+
+        arrays = []
+        for key in signatures:
+            self.entries.move_to_end(key)
+            arrays.append(self.entries[key])
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+        return arrays
+
+    def daily_table(self, users, weekday=True, rng=None):
+        """Sample one day's schedule for every user and return a shower.cdf_table style (table, rows)."""
+        groups = {}
+        for i, user in enumerate(users):
+            groups.setdefault(user.age if weekday else 'weekend', []).append(i)
+
+        signatures = [None] * len(users)
+        for group, members in groups.items():
+            times = sample_schedule_times(group, len(members), rng)
+            times = np.round(np.array(times)/self.resolution).astype(np.int64)*self.resolution
+            for i, key in zip(members, map(tuple, times.T.tolist())):
+                signatures[i] = key + (bool(weekday),)
+
+        unique = list(dict.fromkeys(signatures))
+        index = {key: row for row, key in enumerate(unique)}
+        table = np.array(self.get(unique))
+        return table, np.array([index[key] for key in signatures], dtype=np.int64)
+
 @dataclass
 class UserSchedule:
     """Class representing the user activity schedule."""
 
     weekday: bool
     user: Any
+    # optional numpy.random.Generator, the global random state is used otherwise
+    rng: Any = field(default=None, repr=False)
     
-    up: pd.Timedelta = field(init=False)
-    go: pd.Timedelta = field(init=False)
-    home: pd.Timedelta = field(init=False)
-    sleep: pd.Timedelta = field(init=False)
+    up: timedelta = field(init=False)
+    go: timedelta = field(init=False)
+    home: timedelta = field(init=False)
+    sleep: timedelta = field(init=False)
     pdf: Any = field(init=False, repr=False)
     cdf: Any = field(init=False, repr=False)
 
@@ -33,27 +188,19 @@ class UserSchedule:
 
     def __post_init__(self) -> None:
 
-        diurnal_stats = toml.load(open(os.path.join(DATA_PATH, 'diurnal_distributions.toml'), 'r'))
-        if self.weekday:
-            diurnal_pattern = diurnal_stats[self.user.age]
-        else:
-            diurnal_pattern = diurnal_stats['weekend']
-
-        for key, val in diurnal_pattern.items():
-            dist = val['dist']
-            dist = getattr(sci_stats, dist)
-            mean = round(pd.Timedelta(val['mu']).total_seconds() / 60)
-            std_dev = round(pd.Timedelta(val['sd']).total_seconds() / 60)
-            setattr(self, '_prob_' + key, dist(loc=mean, scale=std_dev))
+        # frozen distributions are shared by every schedule of the same group
+        group = self.user.age if self.weekday else 'weekend'
+        for key, dist in stats_registry.diurnal_samplers(group).items():
+            setattr(self, '_prob_' + key, dist)
 
         self.up = self.sample_single_property('_prob_getting_up')
 
-        self.sleep = self.sample_single_property('_prob_getting_up') - self.sample_single_property('_prob_sleep') + pd.Timedelta(days=1)
+        self.sleep = self.sample_single_property('_prob_getting_up') - self.sample_single_property('_prob_sleep') + timedelta(days=1)
     
         self.go = self.sample_single_property('_prob_leaving_house')
         
         if self.go < self.up:
-            self.go = self.up + pd.Timedelta(minutes=30)
+            self.go = self.up + timedelta(minutes=30)
 
         self.home = self.go + self.sample_single_property('_prob_being_away')
         
@@ -62,70 +209,22 @@ class UserSchedule:
             self.home = self.go  
 
         if self.sleep < self.home:
-            self.home = self.sleep - pd.Timedelta(minutes=30)
+            self.home = self.sleep - timedelta(minutes=30)
     
     def generate_pdf(self, peak=0.65, normal=0.335, away=0.0, night=0.015):
-        index = pd.timedelta_range(start='00:00:00', end='23:59:00', freq='1Min')
-        pdf = pd.Series(index=index, dtype='float64')
-        
-        up = int((self.up.total_seconds()) / 60) % 1440
-        up_p30 = int((up + 30)) % 1440
-
-        go = int(self.go.total_seconds() / 60) % 1440
-        go_m30 = int(go - 30) % 1440
-
-        home = int(self.home.total_seconds() / 60) % 1440
-        home_p30 = int(home + 30) % 1440
-
-        sleep_day, sleep = divmod(int(self.sleep.total_seconds() / 60), 1440)
-        if sleep_day >= 1:
-            sleep_m30 = int(1440-30) % 1440
-        else:
-            sleep_m30 = int(sleep - 30) % 1440
-
-        pdf = self.timeindexer(pdf, 'normal', up_p30, go_m30)
-        pdf = self.timeindexer(pdf, 'peak', up, up_p30)
-        pdf = self.timeindexer(pdf, 'peak', go_m30, go)
-        pdf = self.timeindexer(pdf, 'peak', home, home_p30)
-        pdf = self.timeindexer(pdf, 'away', go, home)
-        
-        if sleep_day >= 1:
-            pdf = self.timeindexer(pdf, 'normal', home_p30, 1440)
-            pdf = self.timeindexer(pdf, 'night', 1440, up)
-        else:
-            pdf = self.timeindexer(pdf, 'normal', home_p30, sleep_m30)
-            pdf = self.timeindexer(pdf, 'peak', sleep_m30, sleep)
-            pdf = self.timeindexer(pdf, 'night', sleep, up)
-        
-        try:
-            pdf[pdf == 'peak'] = peak 
-        except:
-            pass
-        try:
-            pdf[pdf == 'normal'] = normal 
-        except:
-            pass
-        try:
-            pdf[pdf == 'night'] = night 
-        except:
-            pass
-        try:
-            pdf[pdf == 'away'] = 0.0
-        except:
-            pass
-       
-        # normalize stats to produce pdf
-        pdf /= np.sum(pdf)  
-        
-        return pdf
+        up = int(self.up.total_seconds() / 60)
+        go = int(self.go.total_seconds() / 60)
+        home = int(self.home.total_seconds() / 60)
+        sleep = int(self.sleep.total_seconds() / 60)
+        return build_pdf(up, go, home, sleep, peak=peak, normal=normal, away=away, night=night)
             
-    def sample_single_property(self, prop: str) -> pd.Timedelta:
+    def sample_single_property(self, prop: str) -> timedelta:
         """Function to draw random time values from the single time properties (e.g., getting up, leave house, ...) of the users"""
     
         prob_fct = getattr(self, prop)
-        x = prob_fct.rvs()
+        x = prob_fct.rvs(random_state=self.rng)
         x = int(np.round(x))
-        x = pd.Timedelta(minutes=x)
+        x = timedelta(minutes=x)
         return x
     
     def timeindexer(self, l, value, a, b):
@@ -143,6 +242,7 @@ class User:
     #gender: Literal['male', 'female'] = None
     age: Literal['child', 'teen', 'adult', 'home_ad', 'work_ad', 'senior'] = None  
     job: bool = True
+    rng: Any = field(default=None, repr=False)
     schedule: UserSchedule = field(init=False, repr=False)
     
     def __post_init__(self):
@@ -157,7 +257,7 @@ class User:
         self.schedule.cdf = np.cumsum(self.schedule.pdf)
 
     def generate_schedule(self, weekday=True):
-        self.schedule = UserSchedule(user=self, weekday=weekday)
+        self.schedule = UserSchedule(user=self, weekday=weekday, rng=self.rng)
     
     def generate_pdf(self, peak=0.65, normal=0.335, away=0.0, night=0.015):
         self.generate_schedule()
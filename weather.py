@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+Ambient temperature source for the simulation.
+
+The measured hourly temperatures are held in a single contiguous float array
+indexed by hour offset from the first record, wrapping around at the end of
+the record. Parsed CSV data is cached next to the source file as .npz so the
+text file is only parsed again when it changes.
+"""
+import csv
+import os
+import numpy as np
+from settings import DATA_PATH
+
+DEFAULT_PATH = os.path.join(DATA_PATH, "measured_temperatures", "historical_temp_2019_2022.csv")
+DEFAULT_COLUMN = "temperature_2m (°C)"
+
+class WeatherSource:
+    def __init__(self, temperatures, start=None):
+        """Wrap a sequence of hourly ambient temperatures starting at `start`."""
+        self.temperatures = np.ascontiguousarray(temperatures, dtype=np.float64)
+        if self.temperatures.ndim != 1 or len(self.temperatures) == 0:
+            raise ValueError("expected a non-empty 1-D sequence of hourly temperatures")
+        self.start = None if start is None else np.datetime64(start, 'h')
+
+    def __len__(self):
+        return len(self.temperatures)
+
+    def __getitem__(self, hour):
+        """Return the temperature at an hour offset (int or array), wrapping around."""
+        return self.temperatures[np.mod(hour, len(self.temperatures))]
+
+    @classmethod
+    def from_csv(cls, path=DEFAULT_PATH, column=DEFAULT_COLUMN, cache=True):
+        """Load hourly temperatures from a datetime-indexed CSV file.
+
+        With cache enabled the parsed array is stored in <path>.npz and reused
+        for as long as the CSV modification time is unchanged.
+        """
+        cache_path = path + '.npz'
+        mtime = os.path.getmtime(path)
+        if cache and os.path.exists(cache_path):
+            with np.load(cache_path) as cached:
+                if cached['mtime'] == mtime and str(cached['column']) == column:
+                    return cls(cached['temperatures'], start=cached['start'])
+
+        with open(path, 'r', encoding='utf-8', newline='') as csv_file:
+            reader = csv.reader(csv_file)
+            header = next(reader)
+            start = next(reader)[0]
+        temperatures = np.loadtxt(path, delimiter=',', skiprows=1, usecols=header.index(column),
+                                  encoding='utf-8')
+        source = cls(temperatures, start=start)
+
+        if cache:
+            try:
+                np.savez(cache_path, temperatures=source.temperatures, start=source.start,
+                         mtime=mtime, column=column)
+            except OSError:
+                # read-only data directory, parse again next time
+                pass
+        return source
+
+    def window(self, start_hour, hours):
+        """Return `hours` consecutive hourly temperatures from start_hour.
+
+        start_hour may be an array of per-heater offsets, in which case the
+        result has one column per offset.
+        """
+        hour = np.arange(hours).reshape(-1, *np.ones(np.ndim(start_hour), dtype=int))
+        return self[hour + np.asarray(start_hour)]
+
+    def profile(self, start_period, periods, time_step, interpolate=False):
+        """Return the ambient temperature for each of `periods` time steps.
+
+        Time steps are counted from the first record in units of time_step
+        seconds. By default each step uses the temperature of the hour it falls
+        in; with interpolate the hourly values are linearly interpolated.
+        start_period may be an array of per-heater offsets.
+        """
+        period = np.arange(periods).reshape(-1, *np.ones(np.ndim(start_period), dtype=int))
+        seconds = (period + np.asarray(start_period)) * time_step
+        hour, remainder = np.divmod(seconds, 3600)
+        hour = hour.astype(np.int64)
+        if not interpolate:
+            return self[hour]
+        fraction = remainder/3600
+        return self[hour]*(1 - fraction) + self[hour + 1]*fraction
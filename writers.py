@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming result writers for long simulations.
+
+A writer is passed to Simulation.run in place of a results.ResultBuffer. It
+keeps only `chunk_periods` time steps in memory and writes each full chunk to
+disk, so memory use is constant in the simulation length. Chunks are written
+as separate part files named after the periods they cover, each written to a
+temporary name and renamed when complete. A writer opened with resume=True on
+an existing directory continues after the last complete part; it is only for
+continuing an interrupted run through Simulation.resume, and Simulation.run
+rejects it.
+
+Supported formats are 'npz' (compressed NumPy, no extra dependencies), 'csv'
+(gzip-compressed, long format), 'parquet' (requires pyarrow, long format) and
+'hdf5' (requires h5py, a single file of resizable (periods, heaters) datasets).
+"""
+import glob
+import gzip
+import os
+import re
+import numpy as np
+from results import ResultBuffer
+
+class ChunkedWriter:
+    fields = ResultBuffer.fields
+    extension = None
+    part_pattern = re.compile(r'part-(\d+)-(\d+)\.')
+
+    def __init__(self, path, tanks, chunk_periods=1440, dtypes=None, compression=None, resume=False):
+        self.path = path
+        self.tanks = int(tanks)
+        self.chunk_periods = int(chunk_periods)
+        self.compression = compression
+        self.dtypes = dict(ResultBuffer.default_dtypes)
+        self.dtypes.update(dtypes or {})
+        self.chunk = {name: np.empty((self.chunk_periods, self.tanks), dtype=self.dtypes[name])
+                      for name in self.fields}
+        # (day, start_times) pairs recorded since the last write
+        self.days = []
+        self.fill = 0
+        self.period = 0
+        self.day = 0
+
+        os.makedirs(path, exist_ok=True)
+        for tmp in glob.glob(os.path.join(path, '*.tmp')):
+            os.remove(tmp)
+        if resume:
+            self.period, self.day = self.completed()
+        elif self.parts():
+            raise FileExistsError("{0} already holds simulation output, open it with resume=True"
+                                  .format(path))
+
+    @property
+    def data(self):
+        return {'path': self.path, 'periods': self.period, 'days': self.day}
+
+    def parts(self):
+        """Return (start, end, filename) of every complete part, in period order."""
+        parts = []
+        for filename in os.listdir(self.path):
+            match = self.part_pattern.match(filename)
+            if match and filename.endswith('.' + self.extension):
+                parts.append((int(match.group(1)), int(match.group(2)), os.path.join(self.path, filename)))
+        return sorted(parts)
+
+    def completed(self):
+        """Return the number of periods and days stored in the contiguous complete parts."""
+        period = 0
+        day = 0
+        for start, end, filename in self.parts():
+            if start != period:
+                break
+            period = end
+            day = max(day, self.read_days(filename) + 1)
+        return period, day
+
+    def record(self, temperature, power, draw):
+        self.chunk['temperature'][self.fill] = temperature
+        self.chunk['power'][self.fill] = power
+        self.chunk['draw'][self.fill] = draw
+        self.fill += 1
+        self.period += 1
+        if self.fill == self.chunk_periods:
+            self.write()
+
+    def record_block(self, temperature, power, draw):
+        done = 0
+        while done < len(temperature):
+            steps = min(self.chunk_periods - self.fill, len(temperature) - done)
+            for name, values in zip(self.fields, (temperature, power, draw)):
+                self.chunk[name][self.fill:self.fill + steps] = values[done:done + steps]
+            self.fill += steps
+            self.period += steps
+            done += steps
+            if self.fill == self.chunk_periods:
+                self.write()
+
+    def record_day(self, day, start_times):
+        self.days.append((day, np.array(start_times, dtype=self.dtypes['start_times'])))
+        self.day = day + 1
+
+    def flush(self):
+        """Write out the partially filled chunk."""
+        if self.fill or self.days:
+            self.write()
+
+    close = flush
+    sync = flush
+
+    def rewind(self):
+        """Discard parts written after the current period, e.g. when resuming from a checkpoint."""
+        for start, end, filename in self.parts():
+            if start >= self.period - self.fill:
+                self.remove_part(filename)
+
+    def remove_part(self, filename):
+        os.remove(filename)
+
+    def write(self):
+        start = self.period - self.fill
+        filename = os.path.join(self.path, 'part-{0:012d}-{1:012d}.{2}'.format(start, self.period, self.extension))
+        columns = {name: self.chunk[name][:self.fill] for name in self.fields}
+        days = np.array([day for day, _ in self.days], dtype=np.int64)
+        start_times = np.array([times for _, times in self.days], dtype=self.dtypes['start_times']).reshape(-1, self.tanks)
+        self.write_part(filename + '.tmp', start, columns, days, start_times)
+        os.replace(filename + '.tmp', filename)
+        self.fill = 0
+        self.days = []
+
+    def write_part(self, filename, start, columns, days, start_times):
+        raise NotImplementedError
+
+    def read_days(self, filename):
+        """Return the last simulation day recorded in a part, or -1."""
+        raise NotImplementedError
+
+class NpzWriter(ChunkedWriter):
+    extension = 'npz'
+
+    def write_part(self, filename, start, columns, days, start_times):
+        with open(filename, 'wb') as part:
+            save = np.savez if self.compression is False else np.savez_compressed
+            save(part, start=start, days=days, start_times=start_times, **columns)
+
+    def read_days(self, filename):
+        with np.load(filename) as part:
+            return int(part['days'].max()) if len(part['days']) else -1
+
+    def read(self):
+        """Load every complete part back into a dict of (periods, heaters) arrays."""
+        arrays = {name: [] for name in self.fields + ('start_times',)}
+        for start, end, filename in self.parts():
+            with np.load(filename) as part:
+                for name in arrays:
+                    arrays[name].append(part[name])
+        return {name: np.concatenate(values) if values else np.empty((0, self.tanks))
+                for name, values in arrays.items()}
+
+def long_columns(start, columns):
+    """Flatten (steps, heaters) arrays into period/heater/value columns."""
+    steps, tanks = columns['temperature'].shape
+    long = {'period': np.repeat(np.arange(start, start + steps, dtype=np.int64), tanks),
+            'heater': np.tile(np.arange(tanks, dtype=np.int32), steps)}
+    for name, values in columns.items():
+        long[name] = values.ravel()
+    return long
+
+class CsvWriter(ChunkedWriter):
+    extension = 'csv.gz'
+
+    def write_part(self, filename, start, columns, days, start_times):
+        long = long_columns(start, columns)
+        with gzip.open(filename, 'wt', compresslevel=self.compression or 6, newline='') as part:
+            part.write(','.join(long) + '\n')
+            np.savetxt(part, np.column_stack(list(long.values())), delimiter=',',
+                       fmt=['%d', '%d', '%.6g', '%.6g', '%.6g'])
+        # start times go in a companion file, one row per day, written before
+        # the part is renamed into place so a complete part always has one
+        with gzip.open(self.days_filename(filename), 'wt', newline='') as part:
+            part.write('day,' + ','.join('heater_{0}'.format(i) for i in range(self.tanks)) + '\n')
+            np.savetxt(part, np.column_stack([days, start_times]),
+                       delimiter=',', fmt='%d')
+
+    def days_filename(self, filename):
+        name = os.path.basename(filename).replace('part-', 'days-', 1)
+        if name.endswith('.tmp'):
+            name = name[:-len('.tmp')]
+        return os.path.join(os.path.dirname(filename), name)
+
+    def remove_part(self, filename):
+        os.remove(filename)
+        if os.path.exists(self.days_filename(filename)):
+            os.remove(self.days_filename(filename))
+
+    def read_days(self, filename):
+        days = self.days_filename(filename)
+        if not os.path.exists(days):
+            return -1
+        with gzip.open(days, 'rt') as part:
+            rows = part.readlines()[1:]
+        # loadtxt warns on input without data rows
+        if not rows:
+            return -1
+        values = np.loadtxt(rows, delimiter=',', ndmin=2)
+        return int(values[:, 0].max())
+
+class ParquetWriter(ChunkedWriter):
+    extension = 'parquet'
+
+    def __init__(self, *args, **kwargs):
+        try:
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError("parquet output requires pyarrow")
+        super().__init__(*args, **kwargs)
+
+    def write_part(self, filename, start, columns, days, start_times):
+        import pyarrow
+        import pyarrow.parquet
+
+        table = pyarrow.table(long_columns(start, columns))
+        metadata = {b'days': days.tobytes(), b'start_times': start_times.tobytes()}
+        table = table.replace_schema_metadata(metadata)
+        pyarrow.parquet.write_table(table, filename, compression=self.compression or 'zstd')
+
+    def read_days(self, filename):
+        import pyarrow.parquet
+
+        metadata = pyarrow.parquet.read_schema(filename).metadata
+        days = np.frombuffer(metadata[b'days'], dtype=np.int64)
+        return int(days.max()) if len(days) else -1
+
+class Hdf5Writer(ChunkedWriter):
+    extension = 'h5'
+
+    def __init__(self, path, tanks, chunk_periods=1440, dtypes=None, compression=None, resume=False):
+        try:
+            import h5py
+        except ImportError:
+            raise ImportError("hdf5 output requires h5py")
+        self.filename = os.path.join(path, 'results.h5')
+        super().__init__(path, tanks, chunk_periods=chunk_periods, dtypes=dtypes,
+                         compression=compression, resume=resume)
+        with h5py.File(self.filename, 'a') as store:
+            for name in self.fields + ('start_times',):
+                if name in store:
+                    continue
+                store.create_dataset(name, shape=(0, self.tanks), maxshape=(None, self.tanks),
+                                     dtype=self.dtypes[name], chunks=(min(self.chunk_periods, 1024), self.tanks),
+                                     compression=self.compression or 'gzip')
+            store.attrs.setdefault('periods', 0)
+            store.attrs.setdefault('days', 0)
+        self.rewind()
+
+    def parts(self):
+        return [(0, self.completed()[0], self.filename)] if os.path.exists(self.filename) else []
+
+    def completed(self):
+        import h5py
+
+        if not os.path.exists(self.filename):
+            return 0, 0
+        with h5py.File(self.filename, 'r') as store:
+            return int(store.attrs.get('periods', 0)), int(store.attrs.get('days', 0))
+
+    def rewind(self):
+        """Drop rows written after the current period and day."""
+        import h5py
+
+        with h5py.File(self.filename, 'a') as store:
+            for name in self.fields:
+                store[name].resize(self.period - self.fill, axis=0)
+            store['start_times'].resize(min(store['start_times'].shape[0], self.day - len(self.days)), axis=0)
+            store.attrs['periods'] = self.period - self.fill
+            store.attrs['days'] = self.day - len(self.days)
+
+    def write(self):
+        import h5py
+
+        with h5py.File(self.filename, 'a') as store:
+            start = self.period - self.fill
+            for name in self.fields:
+                store[name].resize(self.period, axis=0)
+                store[name][start:self.period] = self.chunk[name][:self.fill]
+            for day, start_times in self.days:
+                store['start_times'].resize(max(store['start_times'].shape[0], day + 1), axis=0)
+                store['start_times'][day] = start_times
+            # the counters mark the data as complete for resuming
+            store.attrs['periods'] = self.period
+            store.attrs['days'] = self.day
+        self.fill = 0
+        self.days = []
+
+formats = {'npz': NpzWriter, 'csv': CsvWriter, 'parquet': ParquetWriter, 'hdf5': Hdf5Writer}
+
+def open_writer(path, tanks, format='npz', **kwargs):
+    """Return a streaming writer of the given format, see ChunkedWriter for the options."""
+    if format not in formats:
+        raise ValueError("unknown output format '{0}', expected one of {1}".format(format, sorted(formats)))
+    return formats[format](path, tanks, **kwargs)